@@ -0,0 +1,159 @@
+import numpy as np
+import torch
+import networkx as nx
+from core.relation_extractor import Relations, RELATION_COLORS
+
+
+#struct-of-arrays scenegraph used by SceneGraph, RealSceneGraph and CarlaSceneGraphBuilder.
+#node type codes, node coordinates (NaN for nodes without a location) and (src, dst, relation) edge triples are kept in numpy arrays.
+#the networkx graph (with its graphviz styling) is only built when it is asked for, e.g. for visualization.
+class ArrayGraph:
+    def __init__(self, node_capacity=16, edge_capacity=64):
+        self.nodes = [] #node objects in insertion order, used for names and visualization
+        self.index = {} #node object -> node index
+        self.node_types = np.zeros(node_capacity, dtype=np.int64)
+        self.coords = np.full((node_capacity, 3), np.nan)
+        self.edge_buffer = EdgeBuffer(edge_capacity) #edges in insertion order, appended while relations are extracted
+        self.edges = np.zeros((3, 0), dtype=np.int64) #rows are src, dst and relation. filled from edge_buffer by freeze
+        self.frozen = False
+        self.entities = None #optional clip-wide entity id of every node, set by IncrementalSceneGraphBuilder
+
+    @classmethod
+    def from_arrays(cls, nodes, node_types, coords, src, dst, relations):
+        graph = cls(node_capacity=0, edge_capacity=0)
+        graph.nodes = nodes
+        graph.index = {node: idx for idx, node in enumerate(nodes)}
+        graph.node_types = np.asarray(node_types, dtype=np.int64)
+        graph.coords = np.asarray(coords, dtype=np.float64)
+        graph.edge_buffer.extend(src, dst, relations)
+        return graph
+
+    @property
+    def num_nodes(self):
+        return len(self.nodes)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_buffer)
+
+    #adds a node and returns its index. location is an (x, y, z) sequence, or None for nodes without a position (road, lanes).
+    def add_node(self, node, node_type, location=None):
+        idx = len(self.nodes)
+        if idx == self.node_types.shape[0]:
+            capacity = max(16, 2 * idx)
+            self.node_types = np.resize(self.node_types, capacity)
+            self.coords = np.concatenate([self.coords, np.full((capacity - idx, 3), np.nan)])
+        self.nodes.append(node)
+        self.index[node] = idx
+        self.node_types[idx] = node_type
+        if location is not None:
+            self.coords[idx, :len(location)] = location
+            self.coords[idx, len(location):] = 0
+        return idx
+
+    def add_edge(self, src, dst, relation):
+        self.edge_buffer.append(src, dst, relation)
+        self.frozen = False
+
+    #adds a batch of edges. src, dst and relations are node indices / relation ids, scalars are broadcast.
+    def add_edges(self, src, dst, relations):
+        self.edge_buffer.extend(src, dst, relations)
+        self.frozen = False
+
+    #trims the arrays to their size and puts the edges in the order networkx iterates them, so cached tensors match the networkx based pipeline.
+    def freeze(self):
+        if not self.frozen:
+            num_nodes = len(self.nodes)
+            self.node_types = self.node_types[:num_nodes]
+            self.coords = self.coords[:num_nodes]
+            src, dst, relations = self.edge_buffer.arrays()
+            order = networkx_edge_order(src, dst, num_nodes)
+            self.edges = np.stack([src[order], dst[order], relations[order]]).astype(np.int64)
+            self.frozen = True
+        return self
+
+    #(2, num_edges) tensor sharing memory with the edge array
+    @property
+    def edge_index(self):
+        return torch.from_numpy(self.freeze().edges[:2])
+
+    #(num_edges,) tensor of relation ids sharing memory with the edge array
+    @property
+    def edge_attr(self):
+        return torch.from_numpy(self.freeze().edges[2])
+
+    #builds the networkx graph with the graphviz styling attributes. node_color maps a node object to its fill color.
+    def to_networkx(self, node_color):
+        g = nx.MultiDiGraph()
+        for node in self.nodes:
+            g.add_node(node, attr=node.attr, label=node.name, style='filled', fillcolor=node_color(node))
+        for src, dst, relation in self.freeze().edges.T.tolist():
+            g.add_edge(self.nodes[src], self.nodes[dst], object=Relations(relation), label=Relations(relation).name, color=RELATION_COLORS[relation])
+        return g
+
+    #(num_edges, 3) array of (src entity, dst entity, relation) triples. needs entities to be set.
+    def entity_triples(self):
+        edges = self.freeze().edges
+        return np.stack([self.entities[edges[0]], self.entities[edges[1]], edges[2]], axis=1)
+
+    def __repr__(self):
+        return "ArrayGraph(nodes=%d, edges=%d)" % (len(self.nodes), self.num_edges)
+
+
+#growable (src, dst, relation) edge columns with compact dtypes. capacity doubles when it runs out, so appending an edge is
+#amortized O(1) and the finished columns are taken as array views without walking any graph structure.
+class EdgeBuffer:
+    def __init__(self, capacity=64):
+        self.src = np.zeros(capacity, dtype=np.int32)
+        self.dst = np.zeros(capacity, dtype=np.int32)
+        self.relations = np.zeros(capacity, dtype=np.uint8)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, size):
+        if size > len(self.src):
+            capacity = max(64, 2 * len(self.src), size)
+            self.src = np.resize(self.src, capacity)
+            self.dst = np.resize(self.dst, capacity)
+            self.relations = np.resize(self.relations, capacity)
+
+    def append(self, src, dst, relation):
+        self.reserve(self.size + 1)
+        self.src[self.size], self.dst[self.size], self.relations[self.size] = src, dst, relation
+        self.size += 1
+
+    def extend(self, src, dst, relations):
+        src, dst, relations = np.broadcast_arrays(*[np.atleast_1d(column) for column in (src, dst, relations)])
+        end = self.size + len(src)
+        self.reserve(end)
+        self.src[self.size:end], self.dst[self.size:end], self.relations[self.size:end] = src, dst, relations
+        self.size = end
+
+    #(src, dst, relations) views of the filled part of the columns
+    def arrays(self):
+        return self.src[:self.size], self.dst[:self.size], self.relations[:self.size]
+
+
+#networkx iterates the edges of a MultiDiGraph grouped by source node, then by the first time each (src, dst) pair was seen.
+#returns the permutation that puts edges given in insertion order into that order.
+def networkx_edge_order(src, dst, num_nodes):
+    emission = np.arange(len(src))
+    _, first_seen, inverse = np.unique(src * num_nodes + dst, return_index=True, return_inverse=True)
+    return np.lexsort((emission, first_seen[inverse.ravel()], src))
+
+
+#(added, removed) relation triples between two graphs whose nodes carry entity ids of the same clip.
+#triples are (src entity, dst entity, relation) rows; previous can be None for the first frame of a clip.
+def edge_diff(previous, graph):
+    current = graph.entity_triples()
+    if previous is None:
+        return current, np.zeros((0, 3), dtype=np.int64)
+    previous = previous.entity_triples()
+    num_entities = max(current[:, :2].max(initial=0), previous[:, :2].max(initial=0)) + 1
+    num_relations = max(current[:, 2].max(initial=0), previous[:, 2].max(initial=0)) + 1
+    encode = lambda triples: (triples[:, 0] * num_entities + triples[:, 1]) * num_relations + triples[:, 2]
+    decode = lambda codes: np.stack([codes // num_relations // num_entities, codes // num_relations % num_entities, codes % num_relations], axis=1)
+    current, previous = encode(current), encode(previous)
+    return decode(np.setdiff1d(current, previous)), decode(np.setdiff1d(previous, current))
@@ -1,23 +1,28 @@
 # -*- coding: utf-8 -*-
 # import some common libraries
 import sys, os
-import math
 import matplotlib
 matplotlib.use("Agg")
 from pathlib import Path
-from tqdm import tqdm
-from collections import defaultdict
 import pickle as pkl
 import json
 import torch
-import pandas as pd
+import numpy as np
 from glob import glob
 sys.path.append(os.path.dirname(sys.path[0]))
 from core.scene_graph import SceneGraph
+from core.scene_graph_builder import CarlaSceneGraphBuilder, IncrementalSceneGraphBuilder, EGO_IDX
+from core.array_graph import ArrayGraph, edge_diff
+from core.frame_selection import select_frames
+from core.clip_pool import load_clips
+from core.payload import node_table, compact_graph, expand_dataset
+from core.featurizer import NodeFeaturizer, NUM_CLASSES
+from core.clip_cache import ClipCache, content_key
+from core.relation_extractor import EXTRACTOR_VERSION
 
 
 class CarlaSceneGraphSequenceGenerator:
-    def __init__(self, framenum, cache_fname='dyngraph_embeddings.pkl'):
+    def __init__(self, framenum, cache_fname='dyngraph_embeddings.pkl', delta_tolerance=None, frame_selection='modulo', relative_features=False, delta_yaw_tolerance=None):
         # [ 
         #   {'node_embeddings':..., 'edge_indexes':..., 'edge_attrs':..., 'label':...}  
         # ]
@@ -28,22 +33,30 @@ class CarlaSceneGraphSequenceGenerator:
 
         # flag for turning on visualization
         self.visualize = False
+
+        # builds the graph tensors with array operations. networkx scenegraphs are only built when visualizing.
+        # with a delta_tolerance (feet) frames are built incrementally and every frame also stores its edge diff to the previous frame.
+        # delta_yaw_tolerance (degrees) is the heading change relative to the ego after which an actor is recomputed. by default it is
+        # 0 with a delta_tolerance of 0, so that builds the exact graphs, and 1 degree otherwise.
+        self.delta_tolerance = delta_tolerance
+        if delta_yaw_tolerance is None and delta_tolerance is not None:
+            delta_yaw_tolerance = 0.0 if delta_tolerance == 0 else 1.0
+        self.delta_yaw_tolerance = delta_yaw_tolerance
+        if delta_tolerance is None:
+            self.builder = CarlaSceneGraphBuilder()
+        else:
+            self.builder = IncrementalSceneGraphBuilder(tolerance=delta_tolerance, yaw_tolerance=delta_yaw_tolerance)
         
         # config used for parsing CARLA:
         # this is the number of global classes defined in CARLA.
-        self.num_classes = 8
-        
-        # gets a list of all feature labels (which will be used) for all scenegraphs
-        # self.feature_list = {"rel_location_x", 
-        #                      "rel_location_y", 
-        #                      "rel_location_z", #add 3 columns for relative vector values
-        #                      "distance_abs", # adding absolute distance to ego
-        #                     }
-        self.feature_list = set()
+        self.num_classes = NUM_CLASSES
+
+        # node features in a fixed, versioned column order: 1hot class labels, then the ego-relative location features if enabled.
+        self.featurizer = NodeFeaturizer(self.num_classes, relative_features=relative_features)
+        self.feature_list = self.featurizer.feature_list
         self.framenum = framenum
-        # create 1hot class labels columns.
-        for i in range(self.num_classes):
-            self.feature_list.add("type_"+str(i))
+        # policy choosing which frames of a clip are kept (see core/frame_selection.py)
+        self.frame_selection = frame_selection
 
     def cache_exists(self):
         return Path(self.cache_filename).exists()
@@ -51,83 +64,140 @@ class CarlaSceneGraphSequenceGenerator:
     def load_from_cache(self):
         with open(self.cache_filename,'rb') as f: 
             self.scenegraphs_sequence , self.feature_list = pkl.load(f)
+        expand_dataset(self.scenegraphs_sequence)
 
-    def load(self, input_path):
+    # workers > 1 processes the clips in a process pool (see core/clip_pool.py). clips are kept in sorted order.
+    # clips that fail are reported and skipped, fail_fast stops at the first failing clip instead.
+    # with a clip_cache directory, clips extracted by an earlier run with the same inputs and settings are reused.
+    def load(self, input_path, workers=1, clip_cache=None, fail_fast=False):
         all_video_clip_dirs = [x for x in input_path.iterdir() if x.is_dir()]
         all_video_clip_dirs = sorted(all_video_clip_dirs, key=lambda x: int(x.stem))
-        for path in tqdm(all_video_clip_dirs):
-            scenegraphs = {} 
-
-            # read all frame numbers from raw_images. and store image_frames (list).
-            raw_images = list(path.glob("raw_images/*.jpg")) + list(path.glob("raw_images/*.png")) 
-
-            scenegraph_txts = sorted(list(glob("%s/**/*.json" % str(path/"scene_raw"), recursive=True)))
+        cache = ClipCache(clip_cache) if clip_cache and not self.visualize else None
+        for path, scenegraphs_dict in load_clips(self, all_video_clip_dirs, workers, cache, fail_fast):
+            self.scenegraphs_sequence.append(scenegraphs_dict)
+
+    # key of the clip in the clip cache: the scene jsons, label.txt, the frames with raw images and every setting the tensors depend on.
+    def clip_key(self, path):
+        raw_images = sorted(img.name for img in list(path.glob("raw_images/*.jpg")) + list(path.glob("raw_images/*.png")))
+        settings = (EXTRACTOR_VERSION, 'carla', self.framenum, self.frame_selection, self.delta_tolerance, self.delta_yaw_tolerance, self.featurizer.schema, raw_images)
+        scenegraph_txts = sorted(glob("%s/**/*.json" % str(path/"scene_raw"), recursive=True))
+        return content_key(settings, scenegraph_txts + [path/"label.txt"], path)
+
+    # builds the scenegraph tensors of one clip directory.
+    def load_clip(self, path):
+        frame_dicts = {} # frame number -> (json path, framedict) of every frame with a raw image
+
+        # read all frame numbers from raw_images. and store image_frames (list).
+        raw_images = list(path.glob("raw_images/*.jpg")) + list(path.glob("raw_images/*.png")) 
+
+        scenegraph_txts = sorted(list(glob("%s/**/*.json" % str(path/"scene_raw"), recursive=True)))
+        for txt_path in scenegraph_txts:
+            with open(txt_path, 'r') as scene_dict_f:
+                try:
+                    framedict = json.loads(scene_dict_f.read())
+                    image_frames = [int(img.stem) for img in raw_images if str(int(img.stem)) in framedict]
+                    image_frames = sorted(image_frames)
+                    #### filling the gap between lane change where some of ego node might miss the invading lane information. ####
+                    start_frame_number = 0; end_frame_number = 0; invading_lane_idx = None
+
+                    for idx, frame_number in enumerate(image_frames):
+                        if "invading_lane" in framedict[str(frame_number)]['ego']:
+                            start_frame_number = idx
+                            invading_lane_idx = framedict[str(frame_number)]['ego']['invading_lane']
+                            break
+
+                    for frame_number in image_frames[::-1]:
+                        if "invading_lane" in framedict[str(frame_number)]['ego']:
+                            end_frame_number = image_frames.index(frame_number)
+                            break
+
+                    for idx in range(start_frame_number, end_frame_number):
+                        framedict[str(image_frames[idx])]['ego']['invading_lane'] = invading_lane_idx
+
+                    image_frames = set(image_frames)
+                    for frame, frame_dict in framedict.items():
+                        if int(frame) in image_frames: # 000111 111
+                            frame_dicts[int(frame)] = (txt_path, frame_dict)
+
+                except Exception as e:
+                    import traceback
+                    print("We have problem parsing the dict.json in %s"%txt_path)
+                    print(e)
+                    traceback.print_exc()
+
+        # frames are selected before any scenegraph is built, so only the kept frames are extracted.
+        selected_frames = set(select_frames(list(frame_dicts.keys()), self.framenum, self.frame_selection))
+        scenegraphs = {}
+        if self.visualize:
             for txt_path in scenegraph_txts:
-                with open(txt_path, 'r') as scene_dict_f:
-                    try:
-                        framedict = json.loads(scene_dict_f.read())
-                        image_frames = [int(img.stem) for img in raw_images if str(int(img.stem)) in framedict]
-                        image_frames = sorted(image_frames)
-                        #### filling the gap between lane change where some of ego node might miss the invading lane information. ####
-                        start_frame_number = 0; end_frame_number = 0; invading_lane_idx = None
-                        
-                        for idx, frame_number in enumerate(image_frames):
-                            if "invading_lane" in framedict[str(frame_number)]['ego']:
-                                start_frame_number = idx
-                                invading_lane_idx = framedict[str(frame_number)]['ego']['invading_lane']
-                                break
-
-                        for frame_number in image_frames[::-1]:
-                            if "invading_lane" in framedict[str(frame_number)]['ego']:
-                                end_frame_number = image_frames.index(frame_number)
-                                break
-                    
-                        for idx in range(start_frame_number, end_frame_number):
-                            framedict[str(image_frames[idx])]['ego']['invading_lane'] = invading_lane_idx
-                        
-                        for frame, frame_dict in framedict.items():
-                            if int(frame) in image_frames: # 000111 111
-                                scenegraph = SceneGraph(frame_dict, framenum=frame)
-                                scenegraphs[int(frame)] = scenegraph
-                            # scenegraph.visualize(filename="./visualize/%s_%s"%(path.name, frame))
-                            
-                    except Exception as e:
-                        import traceback
-                        print("We have problem parsing the dict.json in %s"%txt_path)
-                        print(e)
-                        traceback.print_exc()
-            
-            label_path = (path/"label.txt").resolve()
-
-            if label_path.exists():
-                with open(str(path/"label.txt"), 'r') as label_f:
-                    risk_label = float(label_f.read().strip().split(",")[0])
-
-                if risk_label >= 0:
-                    risk_label = 1
-                else:
-                    risk_label = 0
-
-                # scenegraph_dict contains node embeddings edge indexes and edge attrs.
-                scenegraphs_dict = {}
-                subsampled_scenegraphs, frame_numbers = self.subsample(scenegraphs, self.framenum)
-                scenegraphs_dict['sequence'] = self.process_graph_sequences(subsampled_scenegraphs, frame_numbers, folder_name=path.name)
-                scenegraphs_dict['label'] = risk_label
-                scenegraphs_dict['folder_name'] = path.name
-
-                if self.visualize and (self.clip_ids == None or int(path.stem) in self.clip_ids):
-                    vis_folder_name = path / "carla_visualize"
-                    print("writing scenegraphs to %s"% str(vis_folder_name))
-                    # if vis_folder_name.exists():
-                    #     shutil.rmtree(vis_folder_name)
-                    for scenegraph, frame_number in zip(subsampled_scenegraphs, frame_numbers): 
-                        vis_folder_name.mkdir(exist_ok=True)
-                        scenegraph.visualize(filename=str(vis_folder_name / "{}.png".format(frame_number)))
-
-                self.scenegraphs_sequence.append(scenegraphs_dict)
+                selected = {frame: frame_dict for frame, (frame_path, frame_dict) in frame_dicts.items() if frame_path == txt_path and frame in selected_frames}
+                try:
+                    scenegraphs.update((frame, SceneGraph(frame_dict, framenum=frame)) for frame, frame_dict in selected.items())
+                except Exception as e:
+                    import traceback
+                    print("We have problem parsing the dict.json in %s"%txt_path)
+                    print(e)
+                    traceback.print_exc()
+        else:
+            # all kept frames of the clip are extracted in one batched pass, across the scene jsons of the clip, so the incremental
+            # builder numbers the entities of the whole clip in one table and diffs consecutive frames of different jsons correctly.
+            # if the pass fails, the frames are built one by one to find the bad ones, which are dropped like a failing json was before.
+            selected = {frame: frame_dict for frame, (frame_path, frame_dict) in frame_dicts.items() if frame in selected_frames}
+            try:
+                graphs = self.builder.build_clip(list(selected.values()))
+            except Exception:
+                selected = {frame: frame_dict for frame, frame_dict in selected.items() if self.check_frame(frame_dicts[frame][0], frame, frame_dict)}
+                graphs = self.builder.build_clip(list(selected.values()))
+            scenegraphs.update(zip(selected.keys(), graphs))
+        scenegraphs = {frame: scenegraphs[frame] for frame in frame_dicts if frame in scenegraphs} # clip order
+        if len(scenegraphs) == 0:
+            raise Exception("no scenegraph could be built for %s" % path) # a clip is never emitted with an empty sequence
+
+        label_path = (path/"label.txt").resolve()
+
+        if label_path.exists():
+            with open(str(path/"label.txt"), 'r') as label_f:
+                risk_label = float(label_f.read().strip().split(",")[0])
+
+            if risk_label >= 0:
+                risk_label = 1
             else:
-                raise Exception("no label.txt in %s" % path) 
+                risk_label = 0
+
+            # scenegraph_dict contains node embeddings edge indexes and edge attrs.
+            scenegraphs_dict = {}
+            subsampled_scenegraphs, frame_numbers = list(scenegraphs.values()), list(scenegraphs.keys()) # already subsampled
+            scenegraphs_dict['sequence'] = self.process_graph_sequences(subsampled_scenegraphs, frame_numbers, folder_name=path.name)
+            scenegraphs_dict['label'] = risk_label
+            if self.delta_tolerance is not None and not self.visualize:
+                scenegraphs_dict['entity_names'] = list(self.builder.entity_names)
+            scenegraphs_dict['folder_name'] = path.name
+
+            if self.visualize and (self.clip_ids == None or int(path.stem) in self.clip_ids):
+                vis_folder_name = path / "carla_visualize"
+                print("writing scenegraphs to %s"% str(vis_folder_name))
+                # if vis_folder_name.exists():
+                #     shutil.rmtree(vis_folder_name)
+                for scenegraph, frame_number in zip(subsampled_scenegraphs, frame_numbers): 
+                    vis_folder_name.mkdir(exist_ok=True)
+                    scenegraph.visualize(filename=str(vis_folder_name / "{}.png".format(frame_number)))
+
+            return scenegraphs_dict
+        else:
+            raise Exception("no label.txt in %s" % path) 
     
+    # True if the framedict of a frame builds on its own. reports the frame and its error otherwise.
+    def check_frame(self, txt_path, frame, frame_dict):
+        try:
+            self.builder.build_clip([frame_dict])
+            return True
+        except Exception as e:
+            import traceback
+            print("We have problem parsing frame %s of the dict.json in %s"%(frame, txt_path))
+            print(e)
+            traceback.print_exc()
+            return False
+
     def cache_dataset(self, filename):
         with open(str(filename), 'wb') as f:
             pkl.dump((self.scenegraphs_sequence, self.feature_list), f)
@@ -139,17 +209,23 @@ class CarlaSceneGraphSequenceGenerator:
             in tensor formats.
         '''
         sequence = []
+        previous = None
 
         for idx, (scenegraph, frame_number) in enumerate(zip(scenegraphs, frame_numbers)):
             sg_dict = {}
             
-            node_name2idx = {node:idx for idx, node in enumerate(scenegraph.g.nodes)}
-
-            sg_dict['node_features']                    = self.get_node_embeddings(scenegraph)
-            sg_dict['edge_index'], sg_dict['edge_attr'] = self.get_edge_embeddings(scenegraph, node_name2idx)
+            graph = scenegraph if isinstance(scenegraph, ArrayGraph) else scenegraph.graph
+            if graph.entities is not None:
+                # (src entity, dst entity, relation) triples added and removed since the previous frame of the sequence
+                sg_dict['edges_added'], sg_dict['edges_removed'] = [torch.from_numpy(diff.astype(np.int32)) for diff in edge_diff(previous, graph)]
+                previous = graph
+
+            sg_dict['node_features']                    = self.get_node_embeddings(graph)
+            sg_dict['edge_index'], sg_dict['edge_attr'] = graph.edge_index, graph.edge_attr
             sg_dict['folder_name'] = folder_name
             sg_dict['frame_number'] = frame_number
-            sg_dict['node_order'] = node_name2idx
+            sg_dict['nodes'] = node_table(graph) # names, type codes and actor ids in node index order
+            compact_graph(sg_dict)
             # import pdb; pdb.set_trace()
             sequence.append(sg_dict)
 
@@ -166,76 +242,12 @@ class CarlaSceneGraphSequenceGenerator:
             We expect the length of graph sequences will be homogenenous after running this function.
 
             The default value of number_of_frames will be 20; Could be a tunnable hyperparameters.
+            load() selects the frames before building the scenegraphs; this is kept for scenegraph dicts built elsewhere.
         '''
-        sequence = []
-        frame_numbers = []
-        acc_number = 0
-        modulo = int(len(scenegraphs) / number_of_frames)
-        if modulo == 0:
-            modulo = 1
-
-        for idx, (timeframe, scenegraph) in enumerate(scenegraphs.items()):
-            if idx % modulo == 0 and acc_number < number_of_frames:
-                sequence.append(scenegraph)
-                frame_numbers.append(timeframe)
-                acc_number+=1
+        frame_numbers = select_frames(list(scenegraphs.keys()), number_of_frames, self.frame_selection)
+        sequence = [scenegraphs[frame_number] for frame_number in frame_numbers]
         return sequence, frame_numbers
         
-    def get_node_embeddings(self, scenegraph):
-        rows = []
-        labels=[]
-        ego_attrs = None
-        
-        #extract ego attrs for creating relative features
-        for node, data in scenegraph.g.nodes.items():
-            if "ego:" in str(node):
-                ego_attrs = data['attr']
-        if ego_attrs == None:
-            raise NameError("Ego not found in scenegraph")
-
-        #rotating axes to align with ego. yaw axis is the primary rotation axis in vehicles
-        ego_yaw = math.radians(ego_attrs['rotation'][0])
-        cos_term = math.cos(ego_yaw)
-        sin_term = math.sin(ego_yaw)
-
-        def rotate_coords(x, y): 
-            new_x = (x*cos_term) + (y*sin_term)
-            new_y = ((-x)*sin_term) + (y*cos_term)
-            return new_x, new_y
-            
-        def get_embedding(node, row):
-            #subtract each vector from corresponding vector of ego to find delta         
-            # if "location" in node.attr:
-            #     ego_x, ego_y = rotate_coords(ego_attrs["location"][0], ego_attrs["location"][1])
-            #     node_x, node_y = rotate_coords(node.attr["location"][0], node.attr["location"][1])
-            #     row["rel_location_x"] = node_x - ego_x
-            #     row["rel_location_y"] = node_y - ego_y
-            #     row["rel_location_z"] = node.attr["location"][2] - ego_attrs["location"][2] #no axis rotation needed for Z
-            #     row["distance_abs"] = math.sqrt(row["rel_location_x"]**2 + row["rel_location_y"]**2 + row["rel_location_z"]**2)
-
-            row['type_'+str(node.type)] = 1 #assign 1hot class label
-            return row
-        
-        for idx, node in enumerate(scenegraph.g.nodes):
-            d = defaultdict()
-            row = get_embedding(node, d)
-            labels.append(node.type)
-            rows.append(row)
-            
-        embedding = pd.DataFrame(data=rows, columns=self.feature_list)
-        embedding = embedding.fillna(value=0) #fill in NaN with zeros
-        embedding = torch.FloatTensor(embedding.values)
-        
-        return embedding
-
-    def get_edge_embeddings(self, scenegraph, node_name2idx):
-        edge_index = []
-        edge_attr = []
-        for src, dst, edge in scenegraph.g.edges(data=True):
-            edge_index.append((node_name2idx[src], node_name2idx[dst]))
-            edge_attr.append(edge['object'].value)
-
-        edge_index = torch.transpose(torch.LongTensor(edge_index), 0, 1)
-        edge_attr  = torch.LongTensor(edge_attr)
-        
-        return edge_index, edge_attr
\ No newline at end of file
+    #node features of an ArrayGraph in the column order of self.feature_list. the ego is node EGO_IDX of every CARLA graph.
+    def get_node_embeddings(self, graph):
+        return self.featurizer(graph, EGO_IDX, graph.nodes[EGO_IDX].attr['rotation'][0])
@@ -0,0 +1,89 @@
+import hashlib, os
+import pickle as pkl
+import numpy as np
+import torch
+from pathlib import Path
+
+
+#content addressed cache of extracted clips. every entry is the pickled scenegraphs_dict of one clip, stored under a hash
+#of everything the extraction of the clip depends on (see the generators' clip_key). changed clips get a new key, so a
+#re-run only extracts new or changed clips. stale entries are never read again and can be deleted with the directory.
+class ClipCache:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.directory / (key + ".pkl")
+
+    def get(self, key):
+        try:
+            with open(str(self.path(key)), 'rb') as f:
+                return pkl.load(f)
+        except (OSError, EOFError, pkl.UnpicklingError):
+            return None
+
+    #entries are written to a temporary file and renamed so an interrupted run never leaves a truncated entry behind.
+    def put(self, key, scenegraphs_dict):
+        tmp_path = self.path(key).with_suffix(".tmp%d" % os.getpid())
+        with open(str(tmp_path), 'wb') as f:
+            pkl.dump(scenegraphs_dict, f)
+        os.replace(str(tmp_path), str(self.path(key)))
+
+
+#raw object detections of the image platforms, one compressed .npz file per clip, stored under a hash of the detected images
+#and of the detector config. extraction with changed graph rules finds the detections here and skips the detector.
+#an entry maps frame names to (boxes, classes, scores, image_size, ids) detections (see BatchedPredictor.detect).
+class DetectionCache:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        return self.directory / (key + ".npz")
+
+    def get(self, key):
+        try:
+            with np.load(str(self.path(key))) as entry:
+                offsets = np.cumsum(np.concatenate([[0], entry['counts']]))
+                return {str(frame): (torch.from_numpy(entry['boxes'][start:end].astype(np.float32)),
+                                     torch.from_numpy(entry['classes'][start:end].astype(np.int64)),
+                                     torch.from_numpy(entry['scores'][start:end].astype(np.float32)),
+                                     tuple(int(size) for size in image_size),
+                                     torch.from_numpy(entry['ids'][start:end].astype(np.int64)))
+                        for frame, start, end, image_size in zip(entry['frames'], offsets[:-1], offsets[1:], entry['image_sizes'])}
+        except (OSError, EOFError, KeyError, ValueError):
+            return None
+
+    def put(self, key, detections):
+        frames = list(detections)
+        columns = list(zip(*[detections[frame] for frame in frames])) or [[], [], [], [], []]
+        tmp_path = self.path(key).with_suffix(".tmp%d" % os.getpid())
+        with open(str(tmp_path), 'wb') as f:
+            np.savez_compressed(f, frames=np.array(frames, dtype=str),
+                                counts=np.array([len(classes) for classes in columns[1]], dtype=np.int32),
+                                boxes=np.concatenate([np.zeros((0, 4), dtype=np.float32)] + [boxes.numpy() for boxes in columns[0]]).astype(np.float32),
+                                classes=np.concatenate([np.zeros(0, dtype=np.int16)] + [classes.numpy() for classes in columns[1]]).astype(np.int16),
+                                scores=np.concatenate([np.zeros(0, dtype=np.float32)] + [scores.numpy() for scores in columns[2]]).astype(np.float32),
+                                image_sizes=np.array(columns[3], dtype=np.int32).reshape(-1, 2),
+                                ids=np.concatenate([np.zeros(0, dtype=np.int32)] + [ids.numpy() for ids in columns[4]]).astype(np.int32))
+        os.replace(str(tmp_path), str(self.path(key)))
+
+
+#sha1 hex digest of the settings and of the names and contents of the files.
+#the files in stat_paths (e.g. the raw images of a clip) are not read: they are keyed by their name, size and modification time,
+#so checking the cache for a clip costs a stat per image instead of reading every image.
+def content_key(settings, paths, root, stat_paths=()):
+    key = hashlib.sha1(repr(settings).encode())
+    for path in paths:
+        path = Path(path)
+        key.update(str(path.relative_to(root)).encode())
+        if path.exists():
+            with open(str(path), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    key.update(chunk)
+    for path in stat_paths:
+        path = Path(path)
+        stat = path.stat()
+        key.update(repr((str(path.relative_to(root)), stat.st_size, stat.st_mtime_ns)).encode())
+    return key.hexdigest()
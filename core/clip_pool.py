@@ -0,0 +1,96 @@
+import multiprocessing, traceback
+import pickle as pkl
+import torch
+from tqdm import tqdm
+
+
+#runs generator.load_clip(path) for every clip directory and yields (path, scenegraphs_dict) in the order of clip_dirs.
+#with a ClipCache, clips whose generator.clip_key(path) is cached are loaded from it and only the others are extracted.
+#failing clips are skipped (see extract_clips), or stop the run with fail_fast.
+def load_clips(generator, clip_dirs, workers=1, cache=None, fail_fast=False):
+    keys, cached = {}, {}
+    if cache is not None:
+        for path in clip_dirs:
+            keys[path] = generator.clip_key(path)
+            scenegraphs_dict = cache.get(keys[path])
+            if scenegraphs_dict is not None:
+                cached[path] = scenegraphs_dict
+        print("%d of %d clips loaded from the clip cache" % (len(cached), len(clip_dirs)))
+
+    extracted = extract_clips(generator, [path for path in clip_dirs if path not in cached], workers, fail_fast)
+    for path in clip_dirs:
+        if path in cached:
+            yield path, cached[path]
+            continue
+        _, scenegraphs_dict = next(extracted)
+        if scenegraphs_dict is None:
+            continue
+        if cache is not None:
+            cache.put(keys[path], scenegraphs_dict)
+        yield path, scenegraphs_dict
+    for _ in extracted: #runs extract_clips to its end, which closes the progress bar and prints the failed clips
+        pass
+
+
+#yields (path, scenegraphs_dict) for every clip directory in order.
+#with workers > 1 the clips are spread over a process pool. every worker gets a copy of the generator (generators that
+#hold models rebuild them in __setstate__). workers send back the pickled tensor dicts.
+#serial and pool runs handle a failing clip the same way, so the dataset does not depend on the number of workers: the clip
+#path and traceback are printed, the clip is yielded as None and skipped, and the failed clips are listed at the end.
+#with fail_fast the first failing clip stops the run instead.
+def extract_clips(generator, clip_dirs, workers=1, fail_fast=False):
+    if len(clip_dirs) == 0:
+        return
+    if workers <= 1:
+        results = (load_clip_safely(generator, path, fail_fast) for path in clip_dirs)
+    else:
+        context = multiprocessing.get_context('spawn') #fork is not safe once torch/cuda threads are running in the parent
+        pool = context.Pool(workers, initializer=init_worker, initargs=(generator,))
+        results = pool.imap(load_clip_worker, clip_dirs)
+
+    failed = []
+    try:
+        for path, payload, error in tqdm(results, total=len(clip_dirs)):
+            if error is not None:
+                if fail_fast:
+                    raise RuntimeError("We have problem processing the clip %s\n%s" % (path, error))
+                print("We have problem processing the clip %s, skipping it" % path)
+                print(error)
+                failed.append(path)
+                yield path, None
+            else:
+                yield path, pkl.loads(payload) if workers > 1 else payload
+    finally:
+        if workers > 1:
+            pool.terminate()
+    if failed:
+        print("%d of %d clips failed and were skipped:" % (len(failed), len(clip_dirs)))
+        for path in failed:
+            print("    %s" % path)
+
+
+#(path, scenegraphs_dict, None), or (path, None, traceback) if the clip fails. with fail_fast the error is raised as is.
+def load_clip_safely(generator, path, fail_fast=False):
+    try:
+        return path, generator.load_clip(path), None
+    except Exception:
+        if fail_fast:
+            raise
+        return path, None, traceback.format_exc()
+
+
+worker_generator = None
+
+def init_worker(generator):
+    global worker_generator
+    worker_generator = generator
+    #the pool already uses the cores, avoid oversubscribing them with intra-op threads unless the generator asks for more
+    torch.set_num_threads(getattr(generator, 'torch_threads', None) or 1)
+
+
+def load_clip_worker(path):
+    try:
+        return path, pkl.dumps(worker_generator.load_clip(path)), None
+    except Exception:
+        return path, None, traceback.format_exc()
+
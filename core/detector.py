@@ -0,0 +1,74 @@
+import torch
+from detectron2.engine import DefaultPredictor
+from detectron2.data import transforms as T
+from detectron2.structures import Boxes
+
+
+#runs the model of a detectron2 DefaultPredictor on batches of images instead of one image per call.
+#images are preprocessed the way DefaultPredictor does it (input format, resize to cfg.INPUT.MIN_SIZE_TEST / MAX_SIZE_TEST) and
+#stacked into a single forward call per batch of batch_size images.
+#classes optionally restricts the detections to these class ids (other boxes are dropped before they leave the device).
+#roi optionally crops the images to the (x1, y1, x2, y2) pixel region before inference. boxes are returned in full image coordinates.
+class BatchedPredictor:
+    def __init__(self, cfg, batch_size=8, classes=None, roi=None):
+        self.predictor = DefaultPredictor(cfg)
+        #built here since the attribute of DefaultPredictor holding it differs between detectron2 versions (transform_gen, aug)
+        self.resize = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+        self.batch_size = batch_size
+        self.classes = None if classes is None else torch.tensor(sorted(classes))
+        self.roi = roi
+
+    #list of detectron2 output dicts ({'instances': ...}) for a list of BGR images (as read by cv2.imread).
+    #with a roi the instances are in the coordinates of the cropped images.
+    def predict(self, images):
+        outputs = []
+        for start in range(0, len(images), self.batch_size):
+            outputs += self.forward(images[start:start + self.batch_size])
+        return outputs
+
+    def forward(self, images):
+        inputs = []
+        for image in images:
+            image = self.crop(image)
+            height, width = image.shape[:2]
+            if self.predictor.input_format == "RGB":
+                image = image[:, :, ::-1]
+            image = self.resize.get_transform(image).apply_image(image)
+            inputs.append({"image": torch.as_tensor(image.astype("float32").transpose(2, 0, 1)), "height": height, "width": width})
+        with torch.no_grad():
+            return self.predictor.model(inputs)
+
+    #the roi of an image, the part of the image the model sees (the whole image without a roi)
+    def crop(self, image):
+        if self.roi is None:
+            return image
+        x1, y1, x2, y2 = self.roi
+        return image[y1:y2, x1:x2]
+
+    #(boxes, classes, scores, image_size, ids) detections of every image, boxes as (N, 4) x1, y1, x2, y2 rows and ids the index of
+    #every kept box among all boxes the model returned for the image.
+    #boxes, classes, scores and ids of a whole batch are moved to the cpu in one transfer.
+    def detect(self, images, outputs=None):
+        outputs = self.predict(images) if outputs is None else outputs
+        instances = [output["instances"] for output in outputs]
+        if len(instances) == 0:
+            return []
+        columns = []
+        for x in instances:
+            boxes = x.pred_boxes.tensor
+            ids = torch.arange(len(x), device=boxes.device)
+            if self.roi is not None:
+                boxes = boxes + boxes.new_tensor(self.roi[:2]).repeat(2)
+            rows = torch.cat([boxes, x.pred_classes[:, None].to(boxes.dtype), x.scores[:, None].to(boxes.dtype), ids[:, None].to(boxes.dtype)], 1)
+            if self.classes is not None:
+                rows = rows[(x.pred_classes[:, None] == self.classes.to(boxes.device)[None, :]).any(1)] #torch.isin needs torch >= 1.10
+            columns.append(rows)
+        counts = [len(rows) for rows in columns]
+        detections = torch.cat(columns).cpu()
+        return [(rows[:, :4], rows[:, 4].long(), rows[:, 5], tuple(image.shape[:2]), rows[:, 6].long()) for rows, image in zip(detections.split(counts), images)]
+
+
+#(pred_boxes, pred_classes, image_size, ids) of a detection, the bounding_boxes format RealSceneGraph takes.
+def bounding_boxes(detection):
+    boxes, classes, _, image_size, ids = detection
+    return Boxes(boxes), classes, image_size, ids
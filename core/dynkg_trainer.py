@@ -12,6 +12,8 @@ from sklearn import preprocessing
 from matplotlib import pyplot as plt
 
 from core.relation_extractor import Relations
+from core.tensor_store import TensorStore, is_tensor_store
+from core.payload import expand_dataset
 from argparse import ArgumentParser
 from pathlib import Path
 from tqdm import tqdm
@@ -70,19 +72,29 @@ class Config:
             self.transfer_path = None
         self.stats_path = Path(self.stats_path.strip()).resolve()
 
+#cache_path is either a pickle written by cache_dataset or a columnar store directory (core/tensor_store.py).
+#stores are memory-mapped and split by sequence index, so the returned train/test sets are TensorStore views.
 def build_scenegraph_dataset(cache_path, train_to_test_ratio=0.3, downsample=False, seed=0, transfer_path=None):
-    dataset_file = open(cache_path, "rb")
-    scenegraphs_sequence, feature_list = pkl.load(dataset_file)
+    if is_tensor_store(cache_path):
+        store = TensorStore(cache_path)
+        scenegraphs_sequence, feature_list = list(range(len(store))), store.feature_list
+        labels = store.sequence_labels.tolist()
+    else:
+        dataset_file = open(cache_path, "rb")
+        scenegraphs_sequence, feature_list = pkl.load(dataset_file)
+        expand_dataset(scenegraphs_sequence)
+        store = None
+        labels = [g['label'] for g in scenegraphs_sequence]
 
     if transfer_path == None:
 
         class_0 = []
         class_1 = []
 
-        for g in scenegraphs_sequence:
-            if g['label'] == 0:
+        for g, label in zip(scenegraphs_sequence, labels):
+            if label == 0:
                 class_0.append(g)
-            elif g['label'] == 1:
+            elif label == 1:
                 class_1.append(g)
             
         y_0 = [0]*len(class_0)
@@ -96,13 +108,24 @@ def build_scenegraph_dataset(cache_path, train_to_test_ratio=0.3, downsample=Fal
             
         train, test, train_y, test_y = train_test_split(modified_class_0+class_1, modified_y_0+y_1, test_size=train_to_test_ratio, shuffle=True, stratify=modified_y_0+y_1, random_state=seed)
 
+        if store is not None:
+            return store.subset(train), store.subset(test), feature_list
         return train, test, feature_list
 
     else: 
 
-        test, _ = pkl.load(open(transfer_path, "rb"))
+        test, _ = load_scenegraph_dataset(transfer_path)
+
+        return (store if store is not None else scenegraphs_sequence), test, feature_list 
 
-        return scenegraphs_sequence, test, feature_list 
+#loads a whole dataset (pickle or columnar store) as (scenegraphs_sequence, feature_list)
+def load_scenegraph_dataset(cache_path):
+    if is_tensor_store(cache_path):
+        store = TensorStore(cache_path)
+        return store, store.feature_list
+    with open(cache_path, "rb") as f:
+        scenegraphs_sequence, feature_list = pkl.load(f)
+    return expand_dataset(scenegraphs_sequence), feature_list
 
 class DynKGTrainer:
 
@@ -116,8 +139,8 @@ class DynKGTrainer:
             raise Exception("The cache file does not exist.")    
 
         self.training_data, self.testing_data, self.feature_list = build_scenegraph_dataset(self.config.cache_path, self.config.split_ratio, downsample=self.config.downsample, seed=self.config.seed, transfer_path=self.config.transfer_path)
-        self.training_labels = [data['label'] for data in self.training_data]
-        self.testing_labels = [data['label'] for data in self.testing_data]
+        self.training_labels = dataset_labels(self.training_data)
+        self.testing_labels = dataset_labels(self.testing_data)
         self.class_weights = torch.from_numpy(compute_class_weight('balanced', np.unique(self.training_labels), self.training_labels))
         print("Number of Sequences Included: ", len(self.training_data))
         print("Num Labels in Each Class: " + str(np.unique(self.training_labels, return_counts=True)[1]) + ", Class Weights: " + str(self.class_weights))
@@ -312,6 +335,12 @@ class DynKGTrainer:
             self.model.load_state_dict(torch.load(str(saved_path)))
             self.model.eval()
 
+#labels of a list of sequence dicts or of a TensorStore, without loading the store's tensors
+def dataset_labels(dataset):
+    if isinstance(dataset, TensorStore):
+        return dataset.sequence_labels.tolist()
+    return [data['label'] for data in dataset]
+
 def get_metrics(outputs, labels):
     labels_tensor = torch.LongTensor(labels).detach()
     outputs_tensor = torch.FloatTensor(outputs).detach()
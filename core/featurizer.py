@@ -0,0 +1,39 @@
+import numpy as np
+import torch
+
+
+#version of the node feature schema. bump it when columns are added, removed or reordered; it is part of the clip cache key.
+FEATURE_SCHEMA_VERSION = 1
+NUM_CLASSES = 8 #number of global classes (ActorType codes) defined in CARLA
+TYPE_FEATURES = ["type_"+str(i) for i in range(NUM_CLASSES)] #1hot class label columns, in type code order
+RELATIVE_FEATURES = ["rel_location_x", #location relative to the ego in the ego's frame (x forward, y left/right), z is not rotated
+                     "rel_location_y",
+                     "rel_location_z",
+                     "distance_abs"]   #absolute distance to the ego
+
+
+#builds the node feature matrix of an ArrayGraph in a fixed column order: the 1hot class labels, then (optionally) the
+#ego-relative location features. nodes without a location (road, lanes) get zero relative features.
+class NodeFeaturizer:
+    def __init__(self, num_classes=NUM_CLASSES, relative_features=False):
+        self.num_classes = num_classes
+        self.relative_features = relative_features
+        self.feature_list = TYPE_FEATURES[:num_classes] + (RELATIVE_FEATURES if relative_features else [])
+        self.schema = (FEATURE_SCHEMA_VERSION, tuple(self.feature_list))
+
+    #ego_idx is the node index of the ego, ego_yaw its heading in degrees (0 for image coordinates).
+    def __call__(self, graph, ego_idx=1, ego_yaw=0.0):
+        graph.freeze()
+        num_nodes = graph.num_nodes
+        features = np.zeros((num_nodes, len(self.feature_list)), dtype=np.float32)
+        features[np.arange(num_nodes), graph.node_types] = 1
+
+        if self.relative_features:
+            delta = graph.coords - graph.coords[ego_idx]
+            yaw = np.radians(ego_yaw)
+            cos_term, sin_term = np.cos(yaw), np.sin(yaw)
+            relative = np.stack([delta[:, 0] * cos_term + delta[:, 1] * sin_term, (-delta[:, 0]) * sin_term + delta[:, 1] * cos_term, delta[:, 2]], axis=1)
+            relative = np.nan_to_num(relative)
+            features[:, self.num_classes:self.num_classes+3] = relative
+            features[:, self.num_classes+3] = np.sqrt((relative**2).sum(axis=1))
+        return torch.from_numpy(features)
@@ -0,0 +1,39 @@
+import numpy as np
+
+
+#frame selection policies. each policy takes the frame numbers of a clip (in clip order) and the number of frames to keep,
+#and returns the kept frame numbers. selection only looks at frame numbers so scenegraphs are built for the kept frames only.
+FRAME_SELECTIONS = {}
+
+def frame_selection(name):
+    def register(policy):
+        FRAME_SELECTIONS[name] = policy
+        return policy
+    return register
+
+
+#every modulo-th frame from the start, modulo = len(frames) // number_of_frames. this is the original subsample() behavior.
+@frame_selection('modulo')
+def select_modulo(frame_numbers, number_of_frames):
+    modulo = max(int(len(frame_numbers) / number_of_frames), 1)
+    return list(frame_numbers[::modulo][:number_of_frames])
+
+
+#number_of_frames frames spread evenly between the first and the last frame of the clip.
+@frame_selection('uniform')
+def select_uniform(frame_numbers, number_of_frames):
+    if len(frame_numbers) <= number_of_frames:
+        return list(frame_numbers)
+    return [frame_numbers[idx] for idx in np.unique(np.linspace(0, len(frame_numbers) - 1, number_of_frames).round().astype(int))]
+
+
+#the last number_of_frames frames of the clip.
+@frame_selection('last')
+def select_last(frame_numbers, number_of_frames):
+    return list(frame_numbers[-number_of_frames:]) if number_of_frames > 0 else []
+
+
+def select_frames(frame_numbers, number_of_frames, policy='modulo'):
+    if policy not in FRAME_SELECTIONS:
+        raise ValueError("Unknown frame selection policy: %s. Choose from %s" % (policy, list(FRAME_SELECTIONS)))
+    return FRAME_SELECTIONS[policy](list(frame_numbers), number_of_frames)
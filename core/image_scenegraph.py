@@ -1,14 +1,16 @@
 # -*- coding: utf-8 -*-
-from core.relation_extractor import ActorType, Relations, RELATION_COLORS
+from core.relation_extractor import ActorType, Relations, relation_edges
+from core.spatial_hash import candidate_pairs
+from core.array_graph import ArrayGraph
+from core.lane_extractor import NO_LANE, LEFT_LANE, MIDDLE_LANE, RIGHT_LANE
 from networkx.drawing.nx_agraph import to_agraph
 import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
 import sys
 import os
 import cv2
-import itertools
 import math
+from functools import lru_cache
 import matplotlib
 matplotlib.use("Agg")
 sys.path.append(os.path.dirname(sys.path[0]))
@@ -37,6 +39,8 @@ X_SCALE = 0.46  # 26 pixels = width of lane (12 feet)
 
 H_OFFSET = IMAGE_H - CROPPED_H  # offset from top of image to start of ROI
 
+VEHICLE_CLASSES = ['car', 'truck', 'bus']  # detector classes that become car nodes
+
 CAR_PROXIMITY_THRESH_NEAR_COLL = 4
 # max number of feet between a car and another entity to build proximity relation
 CAR_PROXIMITY_THRESH_SUPER_NEAR = 7
@@ -50,25 +54,40 @@ CENTER_LANE_THRESHOLD = 9
 
 
 class ObjectNode:
+    __slots__ = ('name', 'attr', 'label', 'type')
+
     def __init__(self, name, attr, label):
         self.name = name  # Car-1, Car-2.
         self.attr = attr  # bounding box info
         self.label = label  # ActorType
+        self.type = label.value  # integer type code
 
     def __repr__(self):
         return "%s" % (self.name)
 
+    # caches pickled before ObjectNode had __slots__ store a plain attribute dict, which loads the same way.
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+        if 'type' not in state:
+            self.type = self.label.value
+
 
 class RealSceneGraph:
     ''' 
         scene graph the real images 
         arguments: 
             image_path : path to the image for which the scene graph is generated
+            lane_index : optional LaneIndex of the lane masks of the image. actors are then mapped to the lane containing them.
 
     '''
 
-    def __init__(self, image_path, bounding_boxes, coco_class_names=None, platform='image'):
-        self.g = nx.MultiDiGraph()  # initialize scenegraph as networkx graph
+    def __init__(self, image_path, bounding_boxes, coco_class_names=None, platform='image', lane_index=None):
+        self.graph = ArrayGraph()  # initialize scenegraph as arrays. the networkx graph is built on demand by self.g
+        self._g = None
 
         # road and lane settings.
         # we need to define the type of node.
@@ -87,86 +106,76 @@ class RealSceneGraph:
         self.extract_relative_lanes()  # three lane formulation.
 
         # convert bounding boxes to nodes and build relations.
-        boxes, labels, image_size = bounding_boxes
-        self.get_nodes_from_bboxes(boxes, labels, coco_class_names)
+        # an optional 4th element holds the detection index of every box, for detectors that drop boxes of other classes.
+        boxes, labels, image_size = bounding_boxes[:3]
+        ids = bounding_boxes[3].tolist() if len(bounding_boxes) > 3 else None
+        self.get_nodes_from_bboxes(boxes, labels, coco_class_names, ids, lane_index)
 
         # import pdb; pdb.set_trace()
         self.extract_relations()
 
-    def get_nodes_from_bboxes(self, boxes, labels, coco_class_names):
-        # birds eye view projection
-        M = get_birds_eye_matrix()
+    # ids are the detection indices used in the node names, by default the position of the box.
+    # all boxes of the frame are filtered and projected to the birds eye view as arrays, only the node creation is per box.
+    def get_nodes_from_bboxes(self, boxes, labels, coco_class_names, ids=None, lane_index=None):
         # warped_img = get_birds_eye_warp(image_path, M)
         # cv2.imwrite( "./warped.jpg", cv2.cvtColor(warped_img, cv2.COLOR_BGR2RGB)) #plot warped image
-
-        for idx, (box, label) in enumerate(zip(boxes, labels)):
-            box = box.cpu().numpy().tolist()
-            class_name = coco_class_names[label]
-
-            if box[1] >= 620:
-                continue
-
-            if class_name in ['car', 'truck', 'bus']:
-                actor_type = ActorType.CAR
-            # elif class_name in ['person']:
-            #     actor_type = ActorType.PED
-            # elif class_name in ['bicycle']:
-            #     actor_type = ActorType.BICYCLE
-            # elif class_name in ['motorcycle']:
-            #     actor_type = ActorType.MOTO
-            # elif class_name in ['traffic light']:
-            #     actor_type = ActorType.LIGHT
-            # elif class_name in ['stop sign']:
-            #     actor_type = ActorType.SIGN
-            else:
-                continue
-
-            attr = {'x1': box[0], 'y1': box[1], 'x2': box[2], 'y2': box[3]}
-
-            # map center-bottom of bounding box to warped image
-            x_mid = (box[2] + box[0]) / 2
-            y_bottom = box[3] - H_OFFSET  # offset to account for image crop
-            pt = np.array([[[x_mid, y_bottom]]], dtype='float32')
-            warp_pt = cv2.perspectiveTransform(pt, M)[0][0]
-
-            #locations/distances in feet
-            attr['location_x'] = warp_pt[0] * X_SCALE
-            attr['location_y'] = warp_pt[1] * Y_SCALE
-            attr['rel_location_x'] = attr['location_x'] - \
-                self.ego_node.attr["location_x"]  # x position relative to ego
-            attr['rel_location_y'] = attr['location_y'] - \
-                self.ego_node.attr["location_y"]  # y position relative to ego
-            attr['distance_abs'] = math.sqrt(
-                attr['rel_location_x']**2 + attr['rel_location_y']**2)  # absolute distance from ego
-            node = ObjectNode("%s_%d" % (class_name, idx), attr, actor_type)
-            self.add_node(node)
-            self.add_mapping_to_relative_lanes(node)
+        boxes = np.asarray(getattr(boxes, 'tensor', boxes).cpu().numpy(), dtype=np.float64).reshape(-1, 4)
+        labels = np.asarray(labels.cpu().numpy() if hasattr(labels, 'cpu') else labels, dtype=np.int64)
+        class_names = [coco_class_names[label] for label in labels]
+
+        # elif class_name in ['person']: ActorType.PED, ['bicycle']: ActorType.BICYCLE, ['motorcycle']: ActorType.MOTO,
+        # ['traffic light']: ActorType.LIGHT, ['stop sign']: ActorType.SIGN are not used yet.
+        keep = np.flatnonzero((boxes[:, 1] < 620) & np.array([class_name in VEHICLE_CLASSES for class_name in class_names], dtype=bool))
+
+        # map center-bottom of bounding boxes to warped image, locations/distances in feet
+        locations = project_to_birds_eye(boxes[keep]) * (X_SCALE, Y_SCALE)
+        relative = locations - (self.ego_node.attr["location_x"], self.ego_node.attr["location_y"])  # position relative to ego
+        distances = np.sqrt(relative[:, 0]**2 + relative[:, 1]**2)  # absolute distance from ego
+        # lane containing the center-bottom of every box, in one query of the lane index
+        if lane_index is not None:
+            lanes = lane_index.query((boxes[keep, 0] + boxes[keep, 2]) / 2, boxes[keep, 3]).tolist()
+        else:
+            lanes = [NO_LANE] * len(keep)
+
+        for idx, box, location, rel_location, distance, lane in zip(keep.tolist(), boxes[keep].tolist(), locations.tolist(), relative.tolist(), distances.tolist(), lanes):
+            class_name = class_names[idx]
+            actor_type = ActorType.CAR
+            attr = {'x1': box[0], 'y1': box[1], 'x2': box[2], 'y2': box[3],
+                    'location_x': location[0], 'location_y': location[1],
+                    'rel_location_x': rel_location[0], 'rel_location_y': rel_location[1], 'distance_abs': distance}
+            node = ObjectNode("%s_%d" % (class_name, idx if ids is None else ids[idx]), attr, actor_type)
+            self.add_mapping_to_relative_lanes(node, self.add_node(node), lane)
 
     # extract relations between all nodes in the graph
     # does not build relations with the road node.
     # only builds relations between the ego node and other nodes.
     # only builds relations if other node is within the distance CAR_PROXIMITY_THRESH_VISIBLE from ego.
+    # candidate pairs come from a spatial hash over the car nodes, so road/lane nodes and far apart cars are never visited.
+    # relations are emitted as node index edges and appended to the graph in one batch.
 
     def extract_relations(self):
-        for node_a, node_b in itertools.combinations(self.g.nodes, 2):
+        cars = np.flatnonzero(
+            self.graph.node_types[:self.graph.num_nodes] == ActorType.CAR.value)
+        edges = []
+        for i, j in zip(*candidate_pairs(self.graph.coords[cars, :2], CAR_PROXIMITY_THRESH_VISIBLE)):
+            node_a, node_b = self.graph.nodes[cars[i]], self.graph.nodes[cars[j]]
             relation_list = []
-            if node_a.label == ActorType.ROAD or node_b.label == ActorType.ROAD:
-                # dont build relations w/ road
-                continue
-            if node_a.label == ActorType.CAR and node_b.label == ActorType.CAR:
-                if node_a.name.startswith("Ego") or node_b.name.startswith("Ego"):
-                    # print(node_a, node_b, self.get_euclidean_distance(node_a, node_b))
-                    # import pdb; pdb.set_trace()
-                    if self.get_euclidean_distance(node_a, node_b) <= CAR_PROXIMITY_THRESH_VISIBLE:
-                        relation_list += self.extract_proximity_relations(
-                            node_a, node_b)
-                        relation_list += self.extract_directional_relations(
-                            node_a, node_b)
-                        relation_list += self.extract_proximity_relations(
-                            node_b, node_a)
-                        relation_list += self.extract_directional_relations(
-                            node_b, node_a)
-                        self.add_relations(relation_list)
+            if node_a.name.startswith("Ego") or node_b.name.startswith("Ego"):
+                # print(node_a, node_b, self.get_euclidean_distance(node_a, node_b))
+                # import pdb; pdb.set_trace()
+                if self.get_euclidean_distance(node_a, node_b) <= CAR_PROXIMITY_THRESH_VISIBLE:
+                    relation_list += self.extract_proximity_relations(
+                        node_a, node_b)
+                    relation_list += self.extract_directional_relations(
+                        node_a, node_b)
+                    relation_list += self.extract_proximity_relations(
+                        node_b, node_a)
+                    relation_list += self.extract_directional_relations(
+                        node_b, node_a)
+                    edges += relation_edges(relation_list, node_a, cars[i], node_b, cars[j])
+        if edges:
+            self.graph.add_edges(*zip(*edges))
+            self._g = None
 
     # returns proximity relations based on the absolute distance between two actors.
 
@@ -239,9 +248,9 @@ class RealSceneGraph:
         self.left_lane = ObjectNode("Left Lane", {}, ActorType.LANE)
         self.right_lane = ObjectNode("Right Lane", {}, ActorType.LANE)
         self.middle_lane = ObjectNode("Middle Lane", {}, ActorType.LANE)
-        self.add_node(self.left_lane)
-        self.add_node(self.right_lane)
-        self.add_node(self.middle_lane)
+        self.left_lane_idx = self.add_node(self.left_lane)
+        self.right_lane_idx = self.add_node(self.right_lane)
+        self.middle_lane_idx = self.add_node(self.middle_lane)
         self.add_relation([self.left_lane, Relations.isIn, self.road_node])
         self.add_relation([self.right_lane, Relations.isIn, self.road_node])
         self.add_relation([self.middle_lane, Relations.isIn, self.road_node])
@@ -250,38 +259,48 @@ class RealSceneGraph:
     # builds isIn relation between object and lane depending on x-displacement relative to ego
     # left/middle and right/middle relations have an overlap area determined by the size of CENTER_LANE_THRESHOLD and LANE_THRESHOLD.
     # TODO: move to relation_extractor in replacement of current lane-vehicle relation code
+    # node_idx is the index of object_node in the graph, the edges are added by index.
+    # lane is the lane of the object from the lane masks (see LaneIndex). objects outside every lane mask use the thresholds.
 
-    def add_mapping_to_relative_lanes(self, object_node):
+    def add_mapping_to_relative_lanes(self, object_node, node_idx, lane=NO_LANE):
         # don't build lane relations with static objects
         if object_node.label in [ActorType.LANE, ActorType.LIGHT, ActorType.SIGN, ActorType.ROAD]:
             return
+        if lane != NO_LANE:
+            lane_idx = {LEFT_LANE: self.left_lane_idx, MIDDLE_LANE: self.middle_lane_idx, RIGHT_LANE: self.right_lane_idx}[lane]
+            self.graph.add_edge(node_idx, lane_idx, Relations.isIn.value)
+            return
         if object_node.attr['rel_location_x'] < -LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.left_lane])
+            self.graph.add_edge(node_idx, self.left_lane_idx, Relations.isIn.value)
         elif object_node.attr['rel_location_x'] > LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.right_lane])
+            self.graph.add_edge(node_idx, self.right_lane_idx, Relations.isIn.value)
         if abs(object_node.attr['rel_location_x']) <= CENTER_LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.middle_lane])
+            self.graph.add_edge(node_idx, self.middle_lane_idx, Relations.isIn.value)
 
-    # add single node to graph. node can be any hashable datatype including objects.
+    # networkx version of the graph with graphviz styling. only built when needed (e.g. for visualization).
+
+    @property
+    def g(self):
+        if self._g is None:
+            self._g = self.graph.to_networkx(node_color)
+        return self._g
+
+    # add single node to graph and returns its index. node can be any hashable datatype including objects.
 
     def add_node(self, node):
-        color = "white"
-        if "ego" in node.name.lower():
-            color = "red"
-        elif "car" in node.name.lower():
-            color = "green"
-        elif "lane" in node.name.lower():
-            color = "yellow"
-        self.g.add_node(node, attr=node.attr, label=node.name,
-                        style='filled', fillcolor=color)
+        location = None
+        if 'location_x' in node.attr:
+            location = (node.attr['location_x'], node.attr['location_y'])
+        self._g = None
+        return self.graph.add_node(node, node.type, location)
 
     # add relation (edge) between nodes on graph. relation is a list containing [subject, relation, object]
 
     def add_relation(self, relation):
         if relation != []:
-            if relation[0] in self.g.nodes and relation[2] in self.g.nodes:
-                self.g.add_edge(relation[0], relation[2], object=relation[1],
-                                label=relation[1].name, color=RELATION_COLORS[int(relation[1].value)])
+            if relation[0] in self.graph.index and relation[2] in self.graph.index:
+                self.graph.add_edge(self.graph.index[relation[0]], self.graph.index[relation[2]], relation[1].value)
+                self._g = None
             else:
                 raise NameError(
                     "One or both nodes in relation do not exist in graph. Relation: " + str(relation))
@@ -296,20 +315,47 @@ class RealSceneGraph:
         A.draw(to_filename)
 
 
+# fill color of an image node in the visualization
+def node_color(node):
+    if "ego" in node.name.lower():
+        return "red"
+    elif "car" in node.name.lower():
+        return "green"
+    elif "lane" in node.name.lower():
+        return "yellow"
+    return "white"
+
+
 # ROI: Region of Interest
 # returns transformation matrix for warping image to birds eye projection
 # birds eye matrix fixed for all images using the assumption that camera perspective does not change over time.
-def get_birds_eye_matrix():
+# the homography only depends on the platform constants, so it is computed once per configuration and shared (read-only).
+@lru_cache(maxsize=None)
+def get_birds_eye_matrix(image_w=IMAGE_W, cropped_h=CROPPED_H, birds_eye_w=BIRDS_EYE_IMAGE_W, birds_eye_h=BIRDS_EYE_IMAGE_H):
     # original dimensions (cropped to ROI)
     src = np.float32(
-        [[0, CROPPED_H], [IMAGE_W, CROPPED_H], [0, 0], [IMAGE_W, 0]])
-    dst = np.float32([[int(BIRDS_EYE_IMAGE_W*16/33), BIRDS_EYE_IMAGE_H], [int(BIRDS_EYE_IMAGE_W *
-                                                                              17/33), BIRDS_EYE_IMAGE_H], [0, 0], [BIRDS_EYE_IMAGE_W, 0]])  # warped dimensions
+        [[0, cropped_h], [image_w, cropped_h], [0, 0], [image_w, 0]])
+    dst = np.float32([[int(birds_eye_w*16/33), birds_eye_h], [int(birds_eye_w *
+                                                                17/33), birds_eye_h], [0, 0], [birds_eye_w, 0]])  # warped dimensions
     M = cv2.getPerspectiveTransform(src, dst)  # The transformation matrix
     # Minv = cv2.getPerspectiveTransform(dst, src) # Inverse transformation (if needed)
+    M.setflags(write=False)
     return M
 
 
+# projects the center-bottom points of (N, 4) x1, y1, x2, y2 boxes (full image pixels) to (N, 2) birds eye view pixels.
+# boxes of any number of frames can be projected in one call. computes what cv2.perspectiveTransform does for float32 points.
+def project_to_birds_eye(boxes, M=None):
+    M = get_birds_eye_matrix() if M is None else M
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    points = np.stack([(boxes[:, 2] + boxes[:, 0]) / 2, boxes[:, 3] - H_OFFSET], axis=1)  # offset to account for image crop
+    points = np.concatenate([points.astype(np.float32).astype(np.float64), np.ones((len(points), 1))], axis=1)
+    projected = points @ M.T
+    w = projected[:, 2]
+    scale = np.divide(1.0, w, out=np.zeros_like(w), where=np.abs(w) > np.finfo(np.float32).eps)
+    return (projected[:, :2] * scale[:, None]).astype(np.float32).astype(np.float64)
+
+
 # returns image warped to birds eye projection using M
 # returned image is vertically cropped to the ROI (lane area)
 def get_birds_eye_warp(image_path, M):
@@ -1,39 +1,184 @@
 import pickle as pkl
-from collections import defaultdict
+from collections import OrderedDict
+import numpy as np
 import os
 
 
+LANE_CACHE_BYTES = 256 << 20 #default byte budget of the lanes kept by a LaneExtractor
+PACKED_DIR = "lanedicts.packed" #sidecar of lanedicts.pkl holding its masks bit-packed (see pack_lanedict)
+NO_LANE, LEFT_LANE, MIDDLE_LANE, RIGHT_LANE = 0, 1, 2, 3 #lane of a point relative to the lane of ego (see LaneIndex)
 
+
+#serves the lane masks of the lanedicts.pkl of image directories.
+#the lanes of many directories are kept in an LRU cache bounded by cache_bytes, so interleaved access across clips does not reload
+#them. every lanedicts.pkl is converted once into a packed sidecar directory whose masks are memory-mapped, so a lookup only
+#unpacks the masks of the requested image instead of unpickling the whole dictionary of the directory.
 class LaneExtractor:
-    def __init__(self, image_dir=None):
+    def __init__(self, image_dir=None, cache_bytes=LANE_CACHE_BYTES):
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict() #directory -> PackedLanes, or None if the directory has no lanes
+        self.cached_dir = None
+        self.cached_lanes = None
         if not image_dir == None:
-            self.cached_dir = image_dir
-            self.cached_lanes = self.load_dict(image_dir)
-
+            self.load_dict(image_dir)
 
-    #get lane dict from directory
+    #get lanes of a directory, from the cache or from its lanedicts.pkl
     def load_dict(self, image_dir):
-        filepath = os.path.join(image_dir + "lanedicts.pkl")
-        if not os.path.exists(filepath):
-            print("No lanes found for dir: "+str(image_dir))
-            self.cached_lanes = None
-            self.cached_dir = image_dir
-            return
-
-        with open(filepath, 'rb') as f:
-            lanedict = pkl.load(f)
-        
-        self.cached_lanes = lanedict
-        self.cached_dir = image_dir
+        key = os.path.normpath(image_dir)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = load_packed_lanes(key)
+            while len(self.cache) > 1 and self.cached_bytes() > self.cache_bytes:
+                self.cache.popitem(last=False)
+        self.cached_dir, self.cached_lanes = image_dir, self.cache[key]
+        return self.cached_lanes
 
-        return lanedict
+    #bytes of lane data held by the cache
+    def cached_bytes(self):
+        return sum(lanes.nbytes for lanes in self.cache.values() if lanes is not None)
 
     #return a dictionary containing lane masks for a single image
     #returns None if no lanes were detected for that file/directory
     def get_lanes_from_file(self, filepath):
         file_dir, filename = os.path.split(filepath)
-        if file_dir == self.cached_dir:
-            return self.cached_lanes[filename] if self.cached_lanes != None else None
-        else:
-            self.load_dict(file_dir)
-            return self.cached_lanes[filename] if self.cached_lanes != None else None
+        lanes = self.load_dict(file_dir)
+        return lanes[filename] if lanes != None and filename in lanes else None
+
+    #LaneIndex of the lane masks of a single image, or None if there are no lanes for it.
+    #image_size is the (height, width) of the image the queried points are in.
+    def get_lane_index_from_file(self, filepath, image_size=None):
+        lanes = self.get_lanes_from_file(filepath)
+        if lanes == None or not isinstance(lanes, dict):
+            return None
+        lane_index = LaneIndex(lanes, image_size)
+        return lane_index if lane_index.num_lanes > 0 else None
+
+
+#answers which lane contains a point, for all points of a frame in one query.
+#the 2d lane masks of an image are merged into one label raster (0 = no lane, i = i-th mask), so a query is a single indexing of
+#the raster. every lane is placed left, middle or right of the ego lane: the lane containing the bottom center of the image, or
+#else the lane whose center is closest to it. lanes are ordered by the mean x of their pixels.
+class LaneIndex:
+    def __init__(self, lanes, image_size=None):
+        masks = [mask for mask in lanes.values() if isinstance(mask, np.ndarray) and mask.ndim == 2]
+        masks = [mask.astype(np.bool_) for mask in masks if mask.shape == masks[0].shape][:255] #masks of another resolution are skipped
+        self.num_lanes = len(masks)
+        self.raster = np.zeros(masks[0].shape if masks else (1, 1), dtype=np.uint8)
+        for label, mask in enumerate(masks, 1):
+            self.raster[mask] = label
+        height, width = self.raster.shape
+        #points are scaled from image pixels to mask pixels if the masks have another resolution
+        self.scale = (1.0, 1.0) if image_size is None else (height / image_size[0], width / image_size[1])
+
+        #mean x of the pixels of every mask, from its column sums
+        centers = np.full(self.num_lanes + 1, np.nan)
+        for label, mask in enumerate(masks, 1):
+            column_counts = mask.sum(0)
+            if column_counts.sum() > 0:
+                centers[label] = column_counts @ np.arange(width) / column_counts.sum()
+        ego_label = self.raster[height - 1, width // 2]
+        if ego_label == 0 and self.num_lanes > 0 and np.isfinite(centers[1:]).any():
+            ego_label = 1 + np.nanargmin(np.abs(centers[1:] - width / 2))
+        self.relative = np.full(len(centers), NO_LANE, dtype=np.int64)
+        if ego_label > 0:
+            self.relative[1:][centers[1:] < centers[ego_label]] = LEFT_LANE
+            self.relative[1:][centers[1:] > centers[ego_label]] = RIGHT_LANE
+            self.relative[ego_label] = MIDDLE_LANE
+
+    #LEFT_LANE, MIDDLE_LANE, RIGHT_LANE or NO_LANE of every (x, y) image point, from arrays of x and y
+    def query(self, x, y):
+        height, width = self.raster.shape
+        rows = np.clip(np.floor(np.asarray(y, dtype=np.float64) * self.scale[0]), 0, height - 1).astype(np.int64)
+        cols = np.clip(np.floor(np.asarray(x, dtype=np.float64) * self.scale[1]), 0, width - 1).astype(np.int64)
+        return self.relative[self.raster[rows, cols]]
+
+
+#lanes of one directory, from its packed sidecar (written from lanedicts.pkl if missing or older than the pickle).
+#directories that cannot be written to (e.g. a read-only NAS mount) are packed in memory instead.
+#data.npy and then index.pkl are each written to a tmp file and renamed, so readers (other workers, or processes with the old
+#data.npy memory-mapped) never see a partly written file. the index holds the size of its data, a reader that reads an index
+#and the data.npy of a concurrent rebuild packs the pickle itself.
+def load_packed_lanes(image_dir):
+    filepath = os.path.join(image_dir, "lanedicts.pkl")
+    if not os.path.exists(filepath):
+        print("No lanes found for dir: "+str(image_dir))
+        return None
+
+    packed_dir = os.path.join(image_dir, PACKED_DIR)
+    index_path, data_path = os.path.join(packed_dir, "index.pkl"), os.path.join(packed_dir, "data.npy")
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(filepath):
+        try:
+            with open(index_path, 'rb') as f:
+                stored = pkl.load(f)
+            data = np.load(data_path, mmap_mode='r')
+            if isinstance(stored, tuple) and stored[0] == data.size:
+                return PackedLanes(stored[1], data)
+        except (OSError, EOFError, ValueError, pkl.UnpicklingError):
+            pass
+
+    with open(filepath, 'rb') as f:
+        lanedict = pkl.load(f)
+    index, data = pack_lanedict(lanedict)
+    try:
+        os.makedirs(packed_dir, exist_ok=True)
+        tmp_suffix = ".tmp%d" % os.getpid()
+        with open(data_path + tmp_suffix, 'wb') as f:
+            np.save(f, data)
+        os.replace(data_path + tmp_suffix, data_path)
+        with open(index_path + tmp_suffix, 'wb') as f:
+            pkl.dump((data.size, index), f)
+        os.replace(index_path + tmp_suffix, index_path) #the index is written last, so a sidecar with an index is complete
+    except OSError:
+        pass
+    return PackedLanes(index, data)
+
+
+#splits a lanedict (image filename -> dict of lane masks, or a single mask array) into a small index and one uint8 data array.
+#binary masks are stored with np.packbits (1 bit per pixel), other arrays as their raw bytes.
+#index maps a filename to (is_dict, [(lane key, shape, dtype, packed, offset, nbytes)]). values that are not arrays are kept in the index.
+def pack_lanedict(lanedict):
+    index, chunks, offset = {}, [], 0
+    for filename, lanes in lanedict.items():
+        is_dict = isinstance(lanes, dict)
+        entries = []
+        for lane_key, mask in (lanes.items() if is_dict else [(None, lanes)]):
+            if not isinstance(mask, np.ndarray):
+                entries.append((lane_key, None, None, None, mask, None))
+                continue
+            packed = mask.dtype == np.bool_ or (mask.size > 0 and mask.dtype.kind in 'iu' and mask.min() >= 0 and mask.max() <= 1)
+            chunk = np.packbits(mask.ravel().astype(np.bool_)) if packed else np.ascontiguousarray(mask).view(np.uint8).ravel()
+            entries.append((lane_key, mask.shape, mask.dtype.str, packed, offset, chunk.size))
+            chunks.append(chunk)
+            offset += chunk.size
+        index[filename] = (is_dict, entries)
+    return index, np.concatenate([np.zeros(0, dtype=np.uint8)] + chunks)
+
+
+#read side of pack_lanedict. lanes[filename] unpacks the masks of one image from the (memory-mapped) data array.
+class PackedLanes:
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __getitem__(self, filename):
+        is_dict, entries = self.index[filename]
+        lanes = {}
+        for lane_key, shape, dtype, packed, offset, nbytes in entries:
+            if shape is None:
+                lanes[lane_key] = offset #not an array, the value itself is kept in the offset field
+                continue
+            chunk = self.data[offset:offset + nbytes]
+            if packed:
+                mask = np.unpackbits(chunk)[:int(np.prod(shape))].reshape(shape).astype(np.dtype(dtype)) #count= needs numpy >= 1.17
+            else:
+                mask = np.array(chunk).view(np.dtype(dtype)).reshape(shape)
+            lanes[lane_key] = mask
+        return lanes if is_dict else lanes[None]
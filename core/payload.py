@@ -0,0 +1,58 @@
+import re, sys
+import numpy as np
+import torch
+
+
+ACTOR_ID_PATTERN = re.compile(r"[:_](\d+)$") #trailing actor id of a node name, e.g. car:1234 (CARLA) or car_3 (images)
+
+
+#compact description of the nodes of a graph, cached instead of the node objects (and their raw attr dicts).
+#names are interned so pickle stores every distinct name once, types are the uint8 ActorType codes and actor_ids the integer
+#id at the end of the node name (-1 for the road, the lanes and the ego).
+def node_table(graph):
+    names = [sys.intern(node.name) for node in graph.nodes]
+    actor_ids = [int(match.group(1)) if match else -1 for match in map(ACTOR_ID_PATTERN.search, names)]
+    return {'names': names,
+            'types': torch.from_numpy(np.asarray(graph.node_types[:len(names)], dtype=np.uint8)),
+            'actor_ids': torch.tensor(actor_ids, dtype=torch.int32)}
+
+
+#smallest signed dtype that holds node indices of a graph with num_nodes nodes
+def index_dtype(num_nodes):
+    return torch.int16 if num_nodes <= np.iinfo(np.int16).max else torch.int32
+
+
+#stores the tensors of a graph dict with small dtypes: 0/1 node features as uint8, edge indices as int16/int32 and
+#relation ids as uint8. expand_graph restores the dtypes the models expect.
+def compact_graph(sg_dict):
+    features = sg_dict['node_features']
+    if ((features == 0) | (features == 1)).all():
+        sg_dict['node_features'] = features.to(torch.uint8)
+    sg_dict['edge_index'] = sg_dict['edge_index'].to(index_dtype(features.shape[0]))
+    sg_dict['edge_attr'] = sg_dict['edge_attr'].to(torch.uint8)
+    return sg_dict
+
+
+def expand_graph(sg_dict):
+    sg_dict['node_features'] = sg_dict['node_features'].float()
+    sg_dict['edge_index'] = sg_dict['edge_index'].long()
+    sg_dict['edge_attr'] = sg_dict['edge_attr'].long()
+    return sg_dict
+
+
+#upcasts every graph of a loaded scenegraphs_sequence in place. caches written with the full dtypes are left as they are.
+def expand_dataset(scenegraphs_sequence):
+    for sequence in scenegraphs_sequence:
+        for sg_dict in sequence['sequence']:
+            expand_graph(sg_dict)
+    return scenegraphs_sequence
+
+
+#node names of a cached graph dict, from the node table or from the node_order of caches written before it existed
+def node_names(sg_dict):
+    if 'nodes' in sg_dict:
+        return sg_dict['nodes']['names']
+    names = [None] * len(sg_dict['node_order'])
+    for node, idx in sg_dict['node_order'].items():
+        names[idx] = node.name
+    return names
@@ -0,0 +1,70 @@
+import collections, queue, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+#helpers chaining the stages of an extraction pipeline (e.g. decode -> detect -> graph) with bounded buffers between them.
+#every stage is a generator, so a stage only runs ahead of the next one by its buffer size and memory stays bounded.
+
+
+#yields fn(item) for every item in order. a pool of threads works on up to depth items ahead of the consumer.
+def prefetch_map(fn, items, threads=4, depth=16):
+    with ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+            pending.append(pool.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+#groups the items into lists of up to size items
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#yields fn(item) for every item in order. the items are consumed and fn is run by a background thread that stays at most
+#maxsize results ahead of the consumer. an exception in the thread is raised in the consumer.
+def threaded_stage(fn, items, maxsize=2):
+    results = queue.Queue(maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def put(result):
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if not put((fn(item), None)):
+                    return
+        except BaseException as error:
+            put((None, error))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, error = results.get()
+            if error is not None:
+                raise error
+            if result is done:
+                return
+            yield result
+    finally:
+        stopped.set() #lets the thread exit if the consumer stops early
@@ -5,10 +5,21 @@ import detectron2.utils.visualizer
 import sys
 from core.relation_extractor import ActorType, Relations, RELATION_COLORS
 from core.scene_graph import SceneGraph
-from core.image_scenegraph import RealSceneGraph
+from core.image_scenegraph import RealSceneGraph, VEHICLE_CLASSES
+from core.array_graph import ArrayGraph
+from core.clip_pool import load_clips
+from core.payload import node_table, compact_graph, expand_dataset
+from core.featurizer import NodeFeaturizer, NUM_CLASSES
+from core.clip_cache import ClipCache, DetectionCache, content_key
+from core.relation_extractor import EXTRACTOR_VERSION
+from core.detector import BatchedPredictor, bounding_boxes
+from core.tracker import select_keyframes, propagate_detections
+from core.video import VideoClip, VideoFrame, read_video_frames, load_video_clips
+from core.frame_selection import select_frames
+from core.lane_extractor import LaneExtractor
+from core.pipeline import prefetch_map, batched, threaded_stage
 from detectron2.data import MetadataCatalog
 from detectron2.config import get_cfg
-from detectron2.engine import DefaultPredictor
 from detectron2 import model_zoo
 from glob import glob
 import pandas as pd
@@ -61,7 +72,8 @@ detectron2.utils.visualizer._create_text_labels = create_text_labels_with_idx
 
 
 class ImageSceneGraphSequenceGenerator:
-    def __init__(self, framenum, cache_fname='real_dyngraph_embeddings.pkl', platform='image'):
+    def __init__(self, framenum, cache_fname='real_dyngraph_embeddings.pkl', platform='image', relative_features=False, detect_batch_size=8, torch_threads=None, decode_threads=4, frame_selection='modulo',
+                 detector_mode='mask', detect_roi=None, detect_min_size=None, detect_every=None, use_lanes=False):
         # [
         #   {'node_embeddings':..., 'edge_indexes':..., 'edge_attrs':..., 'label':...}
         # ]
@@ -78,18 +90,14 @@ class ImageSceneGraphSequenceGenerator:
 
         # config used for parsing CARLA:
         # this is the number of global classes defined in CARLA.
-        self.num_classes = 8
-
-        # gets a list of all feature labels (which will be used) for all scenegraphs
-        # self.feature_list = {"rel_location_x",
-        #                      "rel_location_y", #add 3 columns for relative vector values
-        #                      "distance_abs", # adding absolute distance to ego
-        #                     }
-        self.feature_list = set()
+        self.num_classes = NUM_CLASSES
+
+        # node features in a fixed, versioned column order: 1hot class labels, then the ego-relative location features if enabled.
+        self.featurizer = NodeFeaturizer(self.num_classes, relative_features=relative_features)
+        self.feature_list = self.featurizer.feature_list
         self.framenum = framenum
-        # create 1hot class labels columns.
-        for i in range(self.num_classes):
-            self.feature_list.add("type_"+str(i))
+        # policy choosing which framenum frames of a clip are kept (see core/frame_selection.py). only the kept frames are detected.
+        self.frame_selection = frame_selection
 
         # detectron setup.
         self.cfg = get_cfg()
@@ -100,7 +108,51 @@ class ImageSceneGraphSequenceGenerator:
             "COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml")
         self.coco_class_names = MetadataCatalog.get(
             self.cfg.DATASETS.TRAIN[0]).get("thing_classes")
-        self.predictor = DefaultPredictor(self.cfg)
+
+        # detector_mode 'box' skips the mask head (only the boxes are used by RealSceneGraph) and keeps only vehicle detections.
+        # the box head and its weights are the same as in 'mask' mode, so the graphs do not change.
+        # detect_roi crops the images to an (x1, y1, x2, y2) pixel region before inference and detect_min_size lowers the input
+        # resolution of the detector (shortest side in pixels). both are opt-in since they can change the detections.
+        self.detector_mode = detector_mode
+        self.detect_roi = tuple(detect_roi) if detect_roi else None
+        self.detect_min_size = detect_min_size
+        self.detect_classes = None
+        if detector_mode == 'box':
+            self.cfg.MODEL.MASK_ON = False
+            self.detect_classes = [self.coco_class_names.index(name) for name in VEHICLE_CLASSES]
+        elif detector_mode != 'mask':
+            raise ValueError("Unknown detector mode: %s. Choose from ['mask', 'box']" % detector_mode)
+        # detect_every = k runs the detector on every k-th frame of the clip only and tracks the actors in between (see detect_clip).
+        if detect_every is not None and detect_every < 1:
+            raise ValueError("detect_every must be at least 1, got %s" % detect_every)
+        self.detect_every = detect_every
+        if detect_min_size:
+            self.cfg.INPUT.MAX_SIZE_TEST = int(self.cfg.INPUT.MAX_SIZE_TEST * detect_min_size / self.cfg.INPUT.MIN_SIZE_TEST)
+            self.cfg.INPUT.MIN_SIZE_TEST = detect_min_size
+
+        # frames are detected detect_batch_size at a time in one model forward call.
+        # torch_threads is the number of intra-op threads of torch. it is process-wide, so it is applied by the caller (see
+        # script/2_extract_scenegraphs.py) and by the pool worker initializer (core/clip_pool.py), not here.
+        self.detect_batch_size = detect_batch_size
+        self.torch_threads = torch_threads
+        # images are decoded by decode_threads threads while the previous frames are being detected (see load_clip).
+        self.decode_threads = decode_threads
+        self.predictor = BatchedPredictor(self.cfg, detect_batch_size, self.detect_classes, self.detect_roi)
+        self.detection_cache = None
+        # use_lanes maps actors to lanes with the lane masks of raw_images/lanedicts.pkl (see core/lane_extractor.py) where present.
+        self.lane_extractor = LaneExtractor() if use_lanes else None
+
+    # the detectron predictor is not pickled (e.g. when the generator is sent to pool workers). it is rebuilt from self.cfg.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['predictor']
+        if state['lane_extractor'] is not None:
+            state['lane_extractor'] = LaneExtractor(cache_bytes=self.lane_extractor.cache_bytes) #without the loaded lanes
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.predictor = BatchedPredictor(self.cfg, self.detect_batch_size, self.detect_classes, self.detect_roi)
 
     def cache_exists(self):
         return Path(self.cache_filename).exists()
@@ -108,87 +160,212 @@ class ImageSceneGraphSequenceGenerator:
     def load_from_cache(self):
         with open(self.cache_filename, 'rb') as f:
             self.scenegraphs_sequence, self.feature_list = pkl.load(f)
-
-    def load(self, input_path):
-        all_video_clip_dirs = [x for x in input_path.iterdir() if x.is_dir()]
-
-        # (Honda dataset) create raw_images directory and move *.jpg into that directory
-        if self.platfrom == 'honda':
-            self.format_folders(all_video_clip_dirs)
-
-        for path in tqdm(all_video_clip_dirs):
-            scenegraphs = {}
-            raw_images = sorted(list(path.glob("raw_images/*.jpg")) +
-                                list(path.glob("raw_images/*.png")), key=lambda x: int(x.stem))
-            for raw_image_path in raw_images:
-                frame = raw_image_path.stem
-                # get bounding boxes using detectron.
-                out_img_path = None
-                if self.visualize:
-                    out_img_path = Path(raw_image_path).resolve(
-                    ).parent.parent / "obj_det_results"
-                    out_img_path.mkdir(exist_ok=True)
-                    out_img_path = str(
-                        out_img_path / str(Path(raw_image_path).name))
-                bounding_boxes = self.get_bounding_boxes(
-                    str(raw_image_path), out_img_path=out_img_path)
-                # use two information to generate the corresponding scenegraphs.
-                scenegraph = RealSceneGraph(str(
-                    raw_image_path), bounding_boxes, coco_class_names=self.coco_class_names, platform=self.platfrom)
-                scenegraphs[frame] = scenegraph
-
+        expand_dataset(self.scenegraphs_sequence)
+
+    # workers > 1 processes the clips in a process pool (see core/clip_pool.py). clips are kept in sorted order.
+    # clips that fail are reported and skipped, fail_fast stops at the first failing clip instead.
+    # with a clip_cache directory, clips extracted by an earlier run with the same inputs and settings are reused.
+    # with a detection_cache directory, the detections of clips detected by an earlier run with the same detector are reused.
+    # input_path is a directory of clip directories (raw_images/*.jpg and label.txt), or an events csv of video windows
+    # (see core/video.py) whose frames are decoded straight from the videos without writing image files.
+    def load(self, input_path, workers=1, clip_cache=None, detection_cache=None, fail_fast=False):
+        if input_path.is_file():
+            all_video_clip_dirs = load_video_clips(input_path)
+        else:
+            all_video_clip_dirs = sorted([x for x in input_path.iterdir() if x.is_dir()])
+
+            # (Honda dataset) create raw_images directory and move *.jpg into that directory
+            if self.platfrom == 'honda':
+                self.format_folders(all_video_clip_dirs)
+
+        cache = ClipCache(clip_cache) if clip_cache and not self.visualize else None
+        self.detection_cache = DetectionCache(detection_cache) if detection_cache and not self.visualize else None
+        for path, scenegraphs_dict in load_clips(self, all_video_clip_dirs, workers, cache, fail_fast):
+            self.scenegraphs_sequence.append(scenegraphs_dict)
+
+    # key of the clip in the clip cache: the raw images, label.txt, the detector and every setting the tensors depend on.
+    # raw images (and lane masks) are keyed by name, size and modification time, so a cached clip is not read from disk.
+    # video clips are keyed by their window and label and the identity of the video file.
+    def clip_key(self, path):
+        settings = (EXTRACTOR_VERSION, self.platfrom, self.framenum, self.frame_selection, self.featurizer.schema,
+                    self.cfg.MODEL.WEIGHTS, self.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST, self.detect_roi, self.cfg.INPUT.MIN_SIZE_TEST, self.detect_every,
+                    self.lane_extractor is not None)
+        if isinstance(path, VideoClip):
+            return content_key(settings + (tuple(path), path.video_identity()), [], None)
+        raw_images = sorted(list(path.glob("raw_images/*.jpg")) + list(path.glob("raw_images/*.png")))
+        lanes = [path/"raw_images"/"lanedicts.pkl"] if self.lane_extractor is not None and (path/"raw_images"/"lanedicts.pkl").exists() else []
+        return content_key(settings, [path/"label.txt"], path, raw_images + lanes)
+
+    # key of the detections of raw_images in the detection cache: the images (name, size, modification time) or video frames the
+    # detections are computed from and the full detector config. with detect_every these are all clip frames between the first and
+    # last of raw_images (see detect_clip), so replacing or adding an image in between invalidates the tracked detections.
+    def detection_key(self, path, raw_images, clip_frames=None):
+        settings = ("detections", self.cfg.dump(), self.detect_classes, self.detect_roi, self.detect_every)
+        frames = raw_images
+        if self.detect_every:
+            frames = self.tracked_frames(raw_images, clip_frames)
+            settings += ([raw_image_path.stem for raw_image_path in raw_images],)
+        if isinstance(path, VideoClip):
+            return content_key(settings + (path.video_identity(), [frame.frame_no for frame in frames]), [], None)
+        return content_key(settings, [], path, frames)
+
+    # the clip frames from the first to the last of raw_images, the frames detect_every keyframes are taken from
+    def tracked_frames(self, raw_images, clip_frames=None):
+        if clip_frames is None or len(raw_images) == 0:
+            return raw_images
+        return clip_frames[clip_frames.index(raw_images[0]):clip_frames.index(raw_images[-1]) + 1]
+
+    # image files of a clip directory or VideoFrames of a video clip, in frame order
+    def clip_frames(self, path):
+        if isinstance(path, VideoClip):
+            return path.frames()
+        return sorted(list(path.glob("raw_images/*.jpg")) +
+                      list(path.glob("raw_images/*.png")), key=lambda x: int(x.stem))
+
+    # binary risk label of a clip: 1 if the first value of label.txt (or the label of a video clip) is >= 0.
+    def clip_label(self, path):
+        if isinstance(path, VideoClip):
+            risk_label = path.label
+        else:
             label_path = (path/"label.txt").resolve()
-
-            if label_path.exists():
-                with open(str(path/"label.txt"), 'r') as label_f:
-                    risk_label = float(label_f.read().strip().split(",")[0])
-
-                if risk_label >= 0:
-                    risk_label = 1
-                else:
-                    risk_label = 0
-
-                # scenegraph_dict contains node embeddings edge indexes and edge attrs.
-                scenegraphs_dict = {}
-                subsampled_scenegraphs, frame_numbers = self.subsample(
-                    scenegraphs, self.framenum)
-                scenegraphs_dict['sequence'] = self.process_graph_sequences(
-                    subsampled_scenegraphs, frame_numbers, folder_name=path.name)
-                scenegraphs_dict['label'] = risk_label
-                scenegraphs_dict['folder_name'] = path.name
-
-                if self.visualize and (self.clip_ids == None or int(path.stem) in self.clip_ids):
-                    vis_folder_name = path / "image_visualize"
-                    print("writing scenegraphs to %s" % str(vis_folder_name))
-                    for scenegraph, frame_number in zip(subsampled_scenegraphs, frame_numbers):
-                        vis_folder_name.mkdir(exist_ok=True)
-                        scenegraph.visualize(to_filename=str(
-                            vis_folder_name / "{}.png".format(frame_number)))
-
-                self.scenegraphs_sequence.append(scenegraphs_dict)
-            else:
+            if not label_path.exists():
                 raise Exception("no label.txt in %s" % path)
+            with open(str(path/"label.txt"), 'r') as label_f:
+                risk_label = float(label_f.read().strip().split(",")[0])
+
+        if risk_label >= 0:
+            return 1
+        return 0
+
+    # builds the scenegraph tensors of one clip directory or VideoClip.
+    # frames are selected from the sorted image names first, so the detector only runs on the frames kept in the sequence.
+    def load_clip(self, path):
+        scenegraphs = {}
+        risk_label = self.clip_label(path)
+        clip_frames = self.clip_frames(path)
+        selected_frames = set(select_frames([raw_image_path.stem for raw_image_path in clip_frames], self.framenum, self.frame_selection))
+        raw_images = [raw_image_path for raw_image_path in clip_frames if raw_image_path.stem in selected_frames]
+        for raw_image_path, detection in self.detect_clip(path, raw_images, clip_frames):
+            # use two information to generate the corresponding scenegraphs.
+            scenegraph = RealSceneGraph(str(
+                raw_image_path), bounding_boxes(detection), coco_class_names=self.coco_class_names, platform=self.platfrom,
+                lane_index=self.get_lane_index(raw_image_path, detection))
+            scenegraphs[raw_image_path.stem] = scenegraph
+
+        # scenegraph_dict contains node embeddings edge indexes and edge attrs.
+        scenegraphs_dict = {}
+        subsampled_scenegraphs, frame_numbers = self.subsample(
+            scenegraphs, self.framenum)
+        scenegraphs_dict['sequence'] = self.process_graph_sequences(
+            subsampled_scenegraphs, frame_numbers, folder_name=path.name)
+        scenegraphs_dict['label'] = risk_label
+        scenegraphs_dict['folder_name'] = path.name
+
+        if self.visualize and (self.clip_ids == None or int(Path(path.name).stem) in self.clip_ids):
+            vis_folder_name = self.visualization_dir(path, "image_visualize")
+            print("writing scenegraphs to %s" % str(vis_folder_name))
+            for scenegraph, frame_number in zip(subsampled_scenegraphs, frame_numbers):
+                vis_folder_name.mkdir(parents=True, exist_ok=True)
+                scenegraph.visualize(to_filename=str(
+                    vis_folder_name / "{}.png".format(frame_number)))
+
+        return scenegraphs_dict
+
+    # LaneIndex of the lane masks of an image file, None without use_lanes, for video frames or if the clip has no lane masks
+    def get_lane_index(self, raw_image_path, detection):
+        if self.lane_extractor is None or isinstance(raw_image_path, VideoFrame):
+            return None
+        return self.lane_extractor.get_lane_index_from_file(str(raw_image_path), image_size=detection[3])
+
+    # output directory of visualizations of a clip: inside the clip directory, or next to the video for video clips.
+    def visualization_dir(self, path, kind):
+        if isinstance(path, VideoClip):
+            return Path(path.video_path).resolve().parent / kind / path.name
+        return path / kind
 
     def cache_dataset(self, filename):
         with open(str(filename), 'wb') as f:
             pkl.dump((self.scenegraphs_sequence, self.feature_list), f)
 
     def get_bounding_boxes(self, img_path, out_img_path=None):
-        im = cv2.imread(img_path)
-        outputs = self.predictor(im)
-        if out_img_path:
-            # We can use `Visualizer` to draw the predictions on the image.
-            v = detectron2.utils.visualizer.Visualizer(
-                im[:, :, ::-1], MetadataCatalog.get(self.cfg.DATASETS.TRAIN[0]), scale=1.2)
-            out = v.draw_instance_predictions(outputs["instances"].to("cpu"))
-            cv2.imwrite(out_img_path, out.get_image()[:, :, ::-1])
+        return self.get_batch_bounding_boxes([img_path], None if out_img_path is None else [out_img_path])[0]
+
+    # detects a batch of images in one model forward call. returns the (pred_boxes, pred_classes, image_size) of every image as cpu tensors.
+    def get_batch_bounding_boxes(self, img_paths, out_img_paths=None):
+        return [bounding_boxes(detection) for detection in self.detect_images([cv2.imread(img_path) for img_path in img_paths], out_img_paths)]
+
+    # yields (image path, detection) for the raw_images of a clip, from the detection cache if the clip was detected before.
+    # with detect_every = k the detector only runs on every k-th frame and the boxes of the other frames come from an IoU tracker
+    # (see core/tracker.py). the detections then carry track ids, so RealSceneGraph names an actor the same in every frame.
+    # the keyframes are every k-th of clip_frames (all frames of the clip) between the first and last of raw_images, not every k-th
+    # selected frame: selected frames can be many frames apart, too far for boxes to overlap or move linearly. only the keyframes
+    # are decoded, so detect_every pays off when it is larger than the spacing of the selected frames.
+    def detect_clip(self, path, raw_images, clip_frames=None):
+        if self.detection_cache is not None:
+            key = self.detection_key(path, raw_images, clip_frames)
+            cached = self.detection_cache.get(key)
+            if cached is not None and all(raw_image_path.stem in cached for raw_image_path in raw_images):
+                for raw_image_path in raw_images:
+                    yield raw_image_path, cached[raw_image_path.stem]
+                return
+
+        detections = {}
+        if self.detect_every:
+            clip_frames = self.tracked_frames(raw_images, clip_frames)
+            keyframes = select_keyframes(clip_frames, self.detect_every)
+            tracked = propagate_detections([raw_image_path.stem for raw_image_path in clip_frames], [keyframe.stem for keyframe in keyframes],
+                                           {keyframe.stem: detection for keyframe, detection in self.run_detector(keyframes)})
+            detections = {raw_image_path.stem: tracked[raw_image_path.stem] for raw_image_path in raw_images}
+            for raw_image_path in raw_images:
+                yield raw_image_path, detections[raw_image_path.stem]
+        else:
+            for raw_image_path, detection in self.run_detector(raw_images):
+                detections[raw_image_path.stem] = detection
+                yield raw_image_path, detection
+        if self.detection_cache is not None:
+            self.detection_cache.put(key, detections)
+
+    # yields (image path, detection) for raw_images. the frames go through pipelined stages: a thread pool decoding the images
+    # ahead of detection, a detection thread running batches of detect_batch_size frames, and the consumer (e.g. scenegraph
+    # construction in load_clip). the stages are connected by bounded buffers, so at most a few batches of decoded images are held in memory.
+    # video frames are decoded sequentially from the video by a background thread instead.
+    def run_detector(self, raw_images):
+        if len(raw_images) > 0 and isinstance(raw_images[0], VideoFrame):
+            decoded = threaded_stage(lambda frame: frame, read_video_frames(raw_images), 2 * self.detect_batch_size)
+        else:
+            decoded = prefetch_map(read_image, raw_images, self.decode_threads, 2 * self.detect_batch_size)
+        for batch, batch_detections in threaded_stage(self.detect_batch, batched(decoded, self.detect_batch_size)):
+            yield from zip(batch, batch_detections)
+
+    # detection stage of run_detector. takes a batch of (image path or VideoFrame, decoded image) and returns (image paths, detections).
+    def detect_batch(self, batch):
+        raw_image_paths = [raw_image_path for raw_image_path, _ in batch]
+        out_img_paths = None
+        if self.visualize:
+            if isinstance(raw_image_paths[0], VideoFrame):
+                out_img_dir = Path(raw_image_paths[0].video_path).resolve().parent / "obj_det_results" / Path(raw_image_paths[0].video_path).stem
+            else:
+                out_img_dir = Path(raw_image_paths[0]).resolve().parent.parent / "obj_det_results"
+            out_img_dir.mkdir(parents=True, exist_ok=True)
+            out_img_paths = [str(out_img_dir / raw_image_path.name) for raw_image_path in raw_image_paths]
+        return raw_image_paths, self.detect_images([image for _, image in batch], out_img_paths)
+
+    # (boxes, classes, scores, image_size) detections of decoded BGR images, detected in batched forward calls.
+    # draws the detections to out_img_paths when given. with a detect_roi they are drawn on the cropped region the detector saw.
+    def detect_images(self, images, out_img_paths=None):
+        outputs = self.predictor.predict(images)
+        if out_img_paths:
+            for im, output, out_img_path in zip(images, outputs, out_img_paths):
+                # We can use `Visualizer` to draw the predictions on the image.
+                v = detectron2.utils.visualizer.Visualizer(
+                    self.predictor.crop(im)[:, :, ::-1], MetadataCatalog.get(self.cfg.DATASETS.TRAIN[0]), scale=1.2)
+                out = v.draw_instance_predictions(output["instances"].to("cpu"))
+                cv2.imwrite(out_img_path, out.get_image()[:, :, ::-1])
 
         # todo: after done scp to server
         # crop im to remove ego car's hood
         # find threshold then remove from pred_boxes, pred_classes, check image_size
-        bounding_boxes = outputs["instances"].pred_boxes, outputs["instances"].pred_classes, outputs["instances"].image_size
-        print(bounding_boxes)
-        return bounding_boxes
+        return self.predictor.detect(images, outputs)
 
     def process_graph_sequences(self, scenegraphs, frame_numbers, folder_name=None):
         '''
@@ -201,15 +378,14 @@ class ImageSceneGraphSequenceGenerator:
         for idx, (scenegraph, frame_number) in enumerate(zip(scenegraphs, frame_numbers)):
             sg_dict = {}
 
-            node_name2idx = {node: idx for idx,
-                             node in enumerate(scenegraph.g.nodes)}
+            graph = scenegraph if isinstance(scenegraph, ArrayGraph) else scenegraph.graph
 
-            sg_dict['node_features'] = self.get_node_embeddings(scenegraph)
-            sg_dict['edge_index'], sg_dict['edge_attr'] = self.get_edge_embeddings(
-                scenegraph, node_name2idx)
+            sg_dict['node_features'] = self.get_node_embeddings(graph)
+            sg_dict['edge_index'], sg_dict['edge_attr'] = graph.edge_index, graph.edge_attr
             sg_dict['folder_name'] = folder_name
             sg_dict['frame_number'] = frame_number
-            sg_dict['node_order'] = node_name2idx
+            sg_dict['nodes'] = node_table(graph) # names, type codes and actor ids in node index order
+            compact_graph(sg_dict)
             sequence.append(sg_dict)
 
         # import pdb; pdb.set_trace()
@@ -227,64 +403,13 @@ class ImageSceneGraphSequenceGenerator:
 
             The default value of number_of_frames will be 20; Could be a tunnable hyperparameters.
         '''
-        sequence = []
-        frame_numbers = []
-        acc_number = 0
-        modulo = int(len(scenegraphs) / number_of_frames)
-        if modulo == 0:
-            modulo = 1
-
-        for idx, (timeframe, scenegraph) in enumerate(scenegraphs.items()):
-            if idx % modulo == 0 and acc_number < number_of_frames:
-                sequence.append(scenegraph)
-                frame_numbers.append(timeframe)
-                acc_number += 1
-
+        frame_numbers = select_frames(list(scenegraphs.keys()), number_of_frames, self.frame_selection)
+        sequence = [scenegraphs[frame_number] for frame_number in frame_numbers]
         return sequence, frame_numbers
 
-    def get_node_embeddings(self, scenegraph):
-        rows = []
-        labels = []
-        ego_attrs = None
-
-        # extract ego attrs for creating relative features
-        for node, data in scenegraph.g.nodes.items():
-            if "ego" in str(node).lower():
-                ego_attrs = data['attr']
-
-        if ego_attrs == None:
-            raise NameError("Ego not found in scenegraph")
-
-        def get_embedding(node, row):
-            # for key in self.feature_list:
-            #     if key in node.attr:
-            #         row[key] = node.attr[key]
-            row['type_'+str(node.label.value)] = 1  # assign 1hot class label
-            return row
-
-        for idx, node in enumerate(scenegraph.g.nodes):
-            d = defaultdict()
-            row = get_embedding(node, d)
-            labels.append(node.label.value)
-            rows.append(row)
-
-        embedding = pd.DataFrame(data=rows, columns=self.feature_list)
-        embedding = embedding.fillna(value=0)  # fill in NaN with zeros
-        embedding = torch.FloatTensor(embedding.values)
-
-        return embedding
-
-    def get_edge_embeddings(self, scenegraph, node_name2idx):
-        edge_index = []
-        edge_attr = []
-        for src, dst, edge in scenegraph.g.edges(data=True):
-            edge_index.append((node_name2idx[src], node_name2idx[dst]))
-            edge_attr.append(edge['object'].value)
-
-        edge_index = torch.transpose(torch.LongTensor(edge_index), 0, 1)
-        edge_attr = torch.LongTensor(edge_attr)
-
-        return edge_index, edge_attr
+    # node features of an ArrayGraph in the column order of self.feature_list. the ego is node 1 (after the road), in image coordinates.
+    def get_node_embeddings(self, graph):
+        return self.featurizer(graph, 1)
 
     def format_folders(self, all_video_clip_dirs):
         print('Begin formatting folders for Honda Dataset')
@@ -297,3 +422,8 @@ class ImageSceneGraphSequenceGenerator:
                     new_path = raw_path / clip.name
                     clip.replace(new_path)
         print('Finish formatting folders for Honda Dataset')
+
+
+# decode stage of ImageSceneGraphSequenceGenerator.load_clip
+def read_image(raw_image_path):
+    return raw_image_path, cv2.imread(str(raw_image_path))
@@ -1,5 +1,6 @@
 from enum import Enum
-import math
+from functools import lru_cache
+import math, itertools
 
 
 MOTO_NAMES = ["Harley-Davidson", "Kawasaki", "Yamaha"]
@@ -14,9 +15,11 @@ CAR_PROXIMITY_THRESH_VISIBLE = 25
 MOTO_PROXIMITY_THRESH = 50
 BICYCLE_PROXIMITY_THRESH = 50
 PED_PROXIMITY_THRESH = 50
+MAX_RELATION_DISTANCE = max(CAR_PROXIMITY_THRESH_VISIBLE, MOTO_PROXIMITY_THRESH, BICYCLE_PROXIMITY_THRESH, PED_PROXIMITY_THRESH) # no relation is built between actors further apart than this
+EXTRACTOR_VERSION = 5 # bump when the extracted relations change. part of the per-clip extraction cache key (core/clip_cache.py)
 
 #defines all types of actors which can exist
-#order of enum values is important as this determines which function is called. DO NOT CHANGE ENUM ORDER
+#order of enum values is important as the values are used as node type ids in the cached datasets. DO NOT CHANGE ENUM ORDER
 class ActorType(Enum):
     CAR = 0 #26, 142, 137:truck
     MOTO = 1 #80
@@ -28,6 +31,26 @@ class ActorType(Enum):
     ROAD = 7
     
 ACTOR_NAMES=['car','moto','bicycle','ped','lane','light','sign', 'road']
+ACTOR_TYPES = tuple(ActorType) # ActorType by integer type code, avoids the Enum lookup of ActorType(code)
+
+#classifies an actor from its CARLA name. memoized since the same few names are seen for every actor of every frame.
+@lru_cache(maxsize=None)
+def actor_type_from_name(name):
+    if name == "Traffic Light":
+        return ActorType.LIGHT
+    if name.split(" ")[0] == "Pedestrian":
+        return ActorType.PED
+    if name.split(" ")[0] in CAR_NAMES:
+        return ActorType.CAR
+    if name.split(" ")[0] in MOTO_NAMES:
+        return ActorType.MOTO
+    if name.split(" ")[0] in BICYCLE_NAMES:
+        return ActorType.BICYCLE
+    if "Sign" in name:
+        return ActorType.SIGN
+
+    # import pdb; pdb.set_trace()
+    raise NameError("Actor name not found for actor with name: " + name)
 
 class Relations(Enum):
     isIn = 0
@@ -46,47 +69,71 @@ class Relations(Enum):
 RELATION_COLORS = ["black", "red", "orange", "yellow", "green", "purple", "blue", 
                 "sienna", "pink", "pink", "pink",  "turquoise", "turquoise", "turquoise", "violet", "violet"]
 
+#relation rules registered per pair of actor types with @relation_rule. the rule of (type1, type2) is called as rule(actor1, actor2)
+#with actor1 of type1. pairs of types without a registered rule never produce relations.
+RELATION_RULES = {}
+
+def relation_rule(type1, type2):
+    def register(rule):
+        RELATION_RULES[(type1, type2)] = rule
+        return rule
+    return register
+
 #This class extracts relations for every pair of entities in a scene
 class RelationExtractor:
     def __init__(self, ego_node):
         self.ego_node = ego_node 
 
+    #maps (ActorType, ActorType) in both orders to (rule, swap). swap is set when the actors need to be passed to the rule in reverse order.
+    #built once after the class body has registered its rules (see build_dispatch_table below the class).
+    dispatch_table = {}
+
+    #types that appear in at least one registered rule. nodes of any other type can be dropped before pairing.
+    active_types = set()
+
+    @classmethod
+    def build_dispatch_table(cls):
+        cls.dispatch_table = {}
+        for (type1, type2), rule in RELATION_RULES.items():
+            cls.dispatch_table[(type1, type2)] = (rule, False)
+            if type1 != type2:
+                cls.dispatch_table[(type2, type1)] = (rule, True)
+        cls.active_types = set(itertools.chain.from_iterable(cls.dispatch_table.keys()))
+
+    #returns True if a relation rule exists for this pair of types
+    def has_rule(self, type1, type2):
+        return (type1, type2) in self.dispatch_table
+
+    #nodes are classified once when they are created, so this only falls back to the attr dict for unclassified nodes.
     def get_actor_type(self, actor):
+        if getattr(actor, "type", None) is not None:
+            return ACTOR_TYPES[actor.type]
         if "curr" in actor.attr.keys():
             return ActorType.LANE
-        if actor.attr["name"] == "Traffic Light":
-            return ActorType.LIGHT
-        if actor.attr["name"].split(" ")[0] == "Pedestrian":
-            return ActorType.PED
-        if actor.attr["name"].split(" ")[0] in CAR_NAMES:
-            return ActorType.CAR
-        if actor.attr["name"].split(" ")[0] in MOTO_NAMES:
-            return ActorType.MOTO
-        if actor.attr["name"].split(" ")[0] in BICYCLE_NAMES:
-            return ActorType.BICYCLE
-        if "Sign" in actor.attr["name"]:
-            return ActorType.SIGN
-
-        # import pdb; pdb.set_trace()
-        raise NameError("Actor name not found for actor with name: " + actor.attr["name"])
+        return actor_type_from_name(actor.attr["name"])
             
     #takes in two entities and extracts all relations between those two entities. extracted relations are bidirectional    
     def extract_relations(self, actor1, actor2):
-        #import pdb; pdb.set_trace()
-        type1 = self.get_actor_type(actor1)
-        type2 = self.get_actor_type(actor2)
-        
-        low_type = min(type1.value, type2.value) #the lower of the two enums.
-        high_type = max(type1.value, type2.value)
-    
-        function_call = "self.extract_relations_"+ACTOR_NAMES[low_type]+"_"+ACTOR_NAMES[high_type]+"(actor1, actor2) if type1.value <= type2.value "\
-                        "else self.extract_relations_"+ACTOR_NAMES[low_type]+"_"+ACTOR_NAMES[high_type]+"(actor2, actor1)"
-        return eval(function_call)
+        return self.extract_typed_relations(actor1, self.get_actor_type(actor1), actor2, self.get_actor_type(actor2))
+
+    #same as extract_relations for callers that already know the ActorType of both entities.
+    def extract_typed_relations(self, actor1, type1, actor2, type2):
+        entry = self.dispatch_table.get((type1, type2))
+        if entry is None:
+            return []
+        rule, swap = entry
+        return rule(self, actor2, actor1) if swap else rule(self, actor1, actor2)
+
+    #same as extract_typed_relations, but returns (src, dst, relation id) edges between the node indices of the two entities.
+    def extract_typed_edges(self, actor1, idx1, type1, actor2, idx2, type2):
+        return relation_edges(self.extract_typed_relations(actor1, type1, actor2, type2), actor1, idx1, actor2, idx2)
            
 
 #~~~~~~~~~specific relations for each pair of actors possible~~~~~~~~~~~~
 #actor 1 corresponds to the first actor in the function name and actor2 the second
+#only the functions registered with @relation_rule are dispatched. the others are kept as placeholders for future rules.
 
+    @relation_rule(ActorType.CAR, ActorType.CAR)
     def extract_relations_car_car(self, actor1, actor2):
         relation_list = []
         # consider the proximity relations with neighboring lanes.
@@ -190,6 +237,7 @@ class RelationExtractor:
         #relation_list.append(self.extract_directional_relation(actor2, actor1))
         return relation_list
         
+    @relation_rule(ActorType.PED, ActorType.PED)
     def extract_relations_ped_ped(self, actor1, actor2):
         relation_list = []
         if(self.euclidean_distance(actor1, actor2) < PED_PROXIMITY_THRESH):
@@ -317,4 +365,13 @@ class RelationExtractor:
         elif actor2.attr['lane_idx'] > actor1.attr['lane_idx']: # actor2 to the right of actor1 
             relation_list.append([actor1, Relations.toLeftOf, actor2])
 
-        return relation_list
\ No newline at end of file
+        return relation_list
+
+
+RelationExtractor.build_dispatch_table()
+
+
+#maps [subject, relation, object] triples between actor1 and actor2 to (src, dst, relation id) edges of their node indices.
+#the rules only relate the two actors they are given, so the nodes are told apart by identity instead of a node -> index lookup.
+def relation_edges(relations, actor1, idx1, actor2, idx2):
+    return [(idx1 if subject is actor1 else idx2, idx1 if obj is actor1 else idx2, relation.value) for subject, relation, obj in relations]
@@ -1,52 +1,75 @@
-import matplotlib, math, itertools
+import matplotlib, math
 matplotlib.use("Agg")
-import networkx as nx
+import numpy as np
 from networkx.drawing.nx_agraph import to_agraph
-from core.relation_extractor import Relations, ActorType, RelationExtractor, RELATION_COLORS
+from core.relation_extractor import Relations, ActorType, RelationExtractor, MAX_RELATION_DISTANCE, ACTOR_TYPES, actor_type_from_name
+from core.spatial_hash import candidate_pairs
+from core.array_graph import ArrayGraph
 
 
 LANE_THRESHOLD = 6 #feet. if object's center is more than this distance away from ego's center, build left or right lane relation
 CENTER_LANE_THRESHOLD = 9 #feet. if object's center is within this distance of ego's center, build middle lane relation
 
+NODE_ATTR_KEYS = ('location', 'rotation', 'lane_idx', 'invading_lane', 'orig_lane_idx') #fields of the CARLA actor json used by the pipeline
+
 
 #class representing a node in the scene graph. this is mainly used for holding the data for each node.
+#type is the integer code of the node's ActorType. actors created without a type are classified from attr['name'].
 class Node:
+    __slots__ = ('name', 'attr', 'label', 'type')
+
     def __init__(self, name, attr, type=None):
         self.name = name
         self.attr = attr
         self.label = name
-        self.type = type.value if type != None else None
+        self.type = type.value if type != None else actor_type_from_name(attr['name']).value
 
     def __repr__(self):
         return "%s" % self.name
 
+    #caches pickled before Node had __slots__ store a plain attribute dict, which loads the same way.
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+#keeps only the numeric fields of an actor json the pipeline reads (drops names, bounding boxes, etc.).
+def node_attr(attr):
+    return {key: attr[key] for key in NODE_ATTR_KEYS if key in attr}
+
 
 #class defining scene graph and its attributes. contains functions for construction and operations
 class SceneGraph:
     
     #graph can be initialized with a framedict to load all objects at once
     def __init__(self, framedict, framenum=None):
-        self.g = nx.MultiDiGraph() #initialize scenegraph as networkx graph
+        self.graph = ArrayGraph() #initialize scenegraph as arrays. the networkx graph is built on demand by self.g
+        self._g = None
         self.road_node = Node("Root Road", {}, ActorType.ROAD)
         self.add_node(self.road_node)   #adding the road as the root node
         self.parse_json(framedict) # processing json framedict
 
-    #add single node to graph. node can be any hashable datatype including objects.
+    #networkx version of the graph with graphviz styling. only built when needed (e.g. for visualization).
+    @property
+    def g(self):
+        if self._g is None:
+            self._g = self.graph.to_networkx(node_color)
+        return self._g
+
+    #add single node to graph and returns its index. node can be any hashable datatype including objects.
     def add_node(self, node):
-        color = "white"
-        if node.name.startswith("ego"):
-            color = "red"
-        elif node.name.startswith("car"):
-            color = "blue"
-        elif node.name.startswith("lane"):
-            color = "yellow"
-        self.g.add_node(node, attr=node.attr, label=node.name, style='filled', fillcolor=color)
+        self._g = None
+        return self.graph.add_node(node, node.type, node.attr.get('location'))
     
     #add relation (edge) between nodes on graph. relation is a list containing [subject, relation, object]
     def add_relation(self, relation):
         if relation != []:
-            if relation[0] in self.g.nodes and relation[2] in self.g.nodes:
-                self.g.add_edge(relation[0], relation[2], object=relation[1], label=relation[1].name, color=RELATION_COLORS[int(relation[1].value)])
+            if relation[0] in self.graph.index and relation[2] in self.graph.index:
+                self.graph.add_edge(self.graph.index[relation[0]], self.graph.index[relation[2]], relation[1].value)
+                self._g = None
             else:
                 raise NameError("One or both nodes in relation do not exist in graph. Relation: " + str(relation))
         
@@ -67,11 +90,9 @@ class SceneGraph:
             if degree <= 80 or (degree >=280 and degree <= 360):
                 # if abs(self.egoNode.attr['lane_idx'] - attr['lane_idx']) <= 1 \
                 # or ("invading_lane" in self.egoNode.attr and (2*self.egoNode.attr['invading_lane'] - self.egoNode.attr['orig_lane_idx']) == attr['lane_idx']):
-                n = Node(actor_id, attr, None)   #using the actor key as the node name and the dict as its attributes.
-                n.name = self.relation_extractor.get_actor_type(n).name.lower() + ":" + actor_id
-                n.type = self.relation_extractor.get_actor_type(n).value
-                self.add_node(n)
-                self.add_mapping_to_relative_lanes(n)
+                actor_type = actor_type_from_name(attr['name'])
+                n = Node(actor_type.name.lower() + ":" + actor_id, node_attr(attr), actor_type)   #using the actor key as the node name and the dict as its attributes.
+                self.add_mapping_to_relative_lanes(n, self.add_node(n))
             
     #adds lanes and their dicts. constructs relation between each lane and the root road node.
     def add_lane_dict(self, lanedict):
@@ -91,7 +112,7 @@ class SceneGraph:
 
     #add the contents of a whole framedict to the graph
     def parse_json(self, framedict):
-        self.egoNode = Node("ego:"+framedict['ego']['name'], framedict['ego'], ActorType.CAR)
+        self.egoNode = Node("ego:"+framedict['ego']['name'], node_attr(framedict['ego']), ActorType.CAR)
         self.add_node(self.egoNode)
 
         #rotating axes to align with ego. yaw axis is the primary rotation axis in vehicles
@@ -111,11 +132,23 @@ class SceneGraph:
         self.extract_semantic_relations()
     
     #calls RelationExtractor to build semantic relations between every pair of entity nodes in graph. call this function after all nodes have been added to graph.
+    #only nodes whose type has a relation rule are paired, and only pairs within MAX_RELATION_DISTANCE are visited.
+    #nodes without a location are paired with every node. relations are emitted as node index edges and appended to the graph in one batch.
     def extract_semantic_relations(self):
-        for node1, node2 in itertools.combinations(self.g.nodes, 2):
-            if node1.name != node2.name: #dont build self-relations
-                if node1.type != ActorType.ROAD.value and node2.type != ActorType.ROAD.value:  # dont build relations w/ road
-                    self.add_relations(self.relation_extractor.extract_relations(node1, node2))
+        graph = self.graph
+        active_types = [actor_type.value for actor_type in self.relation_extractor.active_types] # road/lanes/signs have no rules
+        node_idx = np.flatnonzero(np.isin(graph.node_types[:graph.num_nodes], active_types))
+        unlocated = np.isnan(graph.coords[node_idx, 0])
+        edges = []
+        for i, j in zip(*candidate_pairs(np.nan_to_num(graph.coords[node_idx]), MAX_RELATION_DISTANCE, unlocated)):
+            idx1, idx2 = node_idx[i], node_idx[j]
+            node1, node2 = graph.nodes[idx1], graph.nodes[idx2]
+            type1, type2 = ACTOR_TYPES[node1.type], ACTOR_TYPES[node2.type]
+            if node1.name != node2.name and self.relation_extractor.has_rule(type1, type2): #dont build self-relations
+                edges += self.relation_extractor.extract_typed_edges(node1, idx1, type1, node2, idx2, type2)
+        if edges:
+            graph.add_edges(*zip(*edges))
+            self._g = None
 
     def visualize(self, filename=None):
         A = to_agraph(self.g)
@@ -129,9 +162,9 @@ class SceneGraph:
         self.left_lane = Node("lane_left", {"curr":"lane_left"}, ActorType.LANE)
         self.right_lane = Node("lane_right", {"curr":"lane_right"}, ActorType.LANE)
         self.middle_lane = Node("lane_middle", {"curr":"lane_middle"}, ActorType.LANE)
-        self.add_node(self.left_lane)
-        self.add_node(self.right_lane)
-        self.add_node(self.middle_lane)
+        self.left_lane_idx = self.add_node(self.left_lane)
+        self.right_lane_idx = self.add_node(self.right_lane)
+        self.middle_lane_idx = self.add_node(self.middle_lane)
         self.add_relation([self.left_lane, Relations.isIn, self.road_node])
         self.add_relation([self.right_lane, Relations.isIn, self.road_node])
         self.add_relation([self.middle_lane, Relations.isIn, self.road_node])
@@ -140,22 +173,34 @@ class SceneGraph:
     #builds isIn relation between object and lane depending on x-displacement relative to ego
     #left/middle and right/middle relations have an overlap area determined by the size of CENTER_LANE_THRESHOLD and LANE_THRESHOLD.
     #TODO: move to relation_extractor in replacement of current lane-vehicle relation code
-    def add_mapping_to_relative_lanes(self, object_node):
+    #node_idx is the index of object_node in the graph, the edges are added by index.
+    def add_mapping_to_relative_lanes(self, object_node, node_idx):
         if object_node.label in [ActorType.LANE, ActorType.LIGHT, ActorType.SIGN, ActorType.ROAD]: #don't build lane relations with static objects
             return
         _, ego_y = self.rotate_coords(self.egoNode.attr['location'][0], self.egoNode.attr['location'][1]) #NOTE: X corresponds to forward/back displacement and Y corresponds to left/right displacement
         _, new_y = self.rotate_coords(object_node.attr['location'][0], object_node.attr['location'][1])
         y_diff = new_y - ego_y
         if y_diff < -LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.left_lane])
+            self.graph.add_edge(node_idx, self.left_lane_idx, Relations.isIn.value)
         elif y_diff > LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.right_lane])
+            self.graph.add_edge(node_idx, self.right_lane_idx, Relations.isIn.value)
         if abs(y_diff) <= CENTER_LANE_THRESHOLD:
-            self.add_relation([object_node, Relations.isIn, self.middle_lane])
+            self.graph.add_edge(node_idx, self.middle_lane_idx, Relations.isIn.value)
     
 
     #copied from get_node_embeddings(). rotates coordinates to be relative to ego vector.
     def rotate_coords(self, x, y): 
         new_x = (x*self.ego_cos_term) + (y*self.ego_sin_term)
         new_y = ((-x)*self.ego_sin_term) + (y*self.ego_cos_term)
-        return new_x, new_y
\ No newline at end of file
+        return new_x, new_y
+
+
+#fill color of a CARLA node in the visualization
+def node_color(node):
+    if node.name.startswith("ego"):
+        return "red"
+    elif node.name.startswith("car"):
+        return "blue"
+    elif node.name.startswith("lane"):
+        return "yellow"
+    return "white"
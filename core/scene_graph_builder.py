@@ -0,0 +1,280 @@
+import numpy as np
+from core.relation_extractor import Relations, ActorType, actor_type_from_name, CAR_PROXIMITY_THRESH_NEAR_COLL, CAR_PROXIMITY_THRESH_SUPER_NEAR, \
+                                    CAR_PROXIMITY_THRESH_VERY_NEAR, CAR_PROXIMITY_THRESH_NEAR, CAR_PROXIMITY_THRESH_VISIBLE, PED_PROXIMITY_THRESH
+from core.scene_graph import Node, node_attr, LANE_THRESHOLD, CENTER_LANE_THRESHOLD
+from core.spatial_hash import candidate_pairs
+from core.array_graph import ArrayGraph, edge_diff
+
+
+FOV_DEGREE = 80 #actors whose bearing from the ego heading is larger than this are filtered out (same test as SceneGraph.add_actor_dict)
+
+#upper bounds of the proximity bins, in the order the if/elif chain of RelationExtractor.create_proximity_relations checks them.
+PROXIMITY_THRESHOLDS = np.array([CAR_PROXIMITY_THRESH_NEAR_COLL, CAR_PROXIMITY_THRESH_SUPER_NEAR, CAR_PROXIMITY_THRESH_VERY_NEAR,
+                                 CAR_PROXIMITY_THRESH_NEAR, CAR_PROXIMITY_THRESH_VISIBLE])
+PROXIMITY_RELATIONS = np.array([Relations.near_coll.value, Relations.super_near.value, Relations.very_near.value,
+                                Relations.near.value, Relations.visible.value])
+
+#upper bounds of the 45 degree sectors used by RelationExtractor.extract_directional_relation and the relation of each sector.
+SECTOR_BOUNDS = np.array([45, 90, 135, 180, 225, 270, 315])
+SECTOR_RELATIONS = np.array([Relations.atDRearOf.value, Relations.atSRearOf.value, Relations.inSFrontOf.value, Relations.inDFrontOf.value,
+                             Relations.inDFrontOf.value, Relations.inSFrontOf.value, Relations.atSRearOf.value, Relations.atDRearOf.value])
+
+
+ROAD_IDX, EGO_IDX, LEFT_LANE_IDX, RIGHT_LANE_IDX, MIDDLE_LANE_IDX = range(5) #node indices of the nodes every CARLA scenegraph starts with
+
+#edge blocks in the order SceneGraph adds the relations of a frame
+FIXED_BLOCK, SIGN_BLOCK, LANE_SIDE_BLOCK, LANE_MIDDLE_BLOCK, PROXIMITY_BLOCK, PROXIMITY_BACK_BLOCK, \
+    DIRECTION_BLOCK, LATERAL_BLOCK, DIRECTION_BACK_BLOCK, LATERAL_BACK_BLOCK, PED_BLOCK = range(11)
+
+
+#builds CARLA scenegraphs with array operations instead of walking every actor and every node pair in python.
+#produces ArrayGraphs with exactly the nodes and relations of SceneGraph.
+#build_clip gathers every actor of a clip into (frames x actors) arrays so all frames are extracted in one batched pass.
+class CarlaSceneGraphBuilder:
+    def build(self, framedict):
+        return self.build_clip([framedict])[0]
+
+    #returns one ArrayGraph per framedict
+    def build_clip(self, framedicts):
+        if len(framedicts) == 0:
+            return []
+        self.gather(framedicts)
+        self.add_nodes(framedicts)
+        self.recompute = self.visible #actors whose relations are extracted. subclasses can reuse the relations of the others.
+        self.extract_relations()
+        return self.assemble()
+
+    def extract_relations(self):
+        num_frames = len(self.nodes)
+        self.edge_blocks = []
+        self.add_edges(FIXED_BLOCK, np.repeat(np.arange(num_frames), 4), np.tile([LEFT_LANE_IDX, RIGHT_LANE_IDX, MIDDLE_LANE_IDX, EGO_IDX], num_frames),
+                       np.tile([ROAD_IDX, ROAD_IDX, ROAD_IDX, MIDDLE_LANE_IDX], num_frames), Relations.isIn.value)
+        self.add_edges(SIGN_BLOCK, self.sign_frames, self.sign_idx, ROAD_IDX, Relations.isIn.value)
+        self.add_mapping_to_relative_lanes()
+        self.add_car_relations()
+        self.add_ped_relations()
+
+    def add_edges(self, block, frame, src, dst, relation):
+        frame, src, dst, relation = np.broadcast_arrays(*[np.asarray(column, dtype=np.int64) for column in (frame, src, dst, relation)])
+        self.edge_blocks.append((np.full(len(frame), block), frame, src, dst, relation))
+
+    #splits the edge blocks into one ArrayGraph per frame. edges of a frame are ordered by block, then by the node pair, which is the
+    #order SceneGraph adds them in as far as the networkx edge order (see ArrayGraph.freeze) is concerned.
+    def assemble(self):
+        num_frames = len(self.nodes)
+        block, frame, src, dst, rel = [np.concatenate(column) for column in zip(*self.edge_blocks)]
+        max_nodes = max(len(nodes) for nodes in self.nodes)
+        order = np.lexsort((np.minimum(src, dst) * max_nodes + np.maximum(src, dst), block, frame))
+        frame, src, dst, rel = frame[order], src[order], dst[order], rel[order]
+        bounds = np.searchsorted(frame, np.arange(num_frames + 1))
+
+        graphs = []
+        for t in range(num_frames):
+            edges = slice(bounds[t], bounds[t+1])
+            graphs.append(ArrayGraph.from_arrays(self.nodes[t], self.node_types[t], self.node_coords[t], src[edges], dst[edges], rel[edges]).freeze())
+        return graphs
+
+    #loads the ego and the actors of every frame into arrays. actors are indexed by their position in the clip's set of actor ids.
+    def gather(self, framedicts):
+        num_frames = len(framedicts)
+        self.actor_ids = {}
+        frame_idx, actor_idx, locations, yaws, lanes = [], [], [], [], []
+        for t, framedict in enumerate(framedicts):
+            for actor_id, attr in framedict.get('actors', {}).items():
+                frame_idx.append(t)
+                actor_idx.append(self.actor_ids.setdefault(actor_id, len(self.actor_ids)))
+                locations.append(attr['location'])
+                yaws.append(attr['rotation'][0])
+                lanes.append(attr.get('lane_idx', np.nan))
+
+        num_actors = len(self.actor_ids)
+        self.present = np.zeros((num_frames, num_actors), dtype=bool)
+        self.locations = np.full((num_frames, num_actors, 3), np.nan)
+        self.yaws = np.full((num_frames, num_actors), np.nan)
+        self.lanes = np.full((num_frames, num_actors), np.nan)
+        self.present[frame_idx, actor_idx] = True
+        self.locations[frame_idx, actor_idx] = np.array(locations, dtype=np.float64).reshape(-1, 3)
+        self.yaws[frame_idx, actor_idx] = yaws
+        self.lanes[frame_idx, actor_idx] = lanes
+
+        self.ego_locations = np.array([framedict['ego']['location'] for framedict in framedicts], dtype=np.float64).reshape(-1, 3)
+        self.ego_yaws = np.array([framedict['ego']['rotation'][0] for framedict in framedicts], dtype=np.float64)
+        self.ego_lanes = np.array([framedict['ego'].get('lane_idx', np.nan) for framedict in framedicts], dtype=np.float64)
+        ego_yaw = np.radians(self.ego_yaws)
+        self.ego_cos_terms, self.ego_sin_terms = np.cos(ego_yaw), np.sin(ego_yaw)
+
+        # filter actors behind ego. the denominator is the sum of the vector lengths as in SceneGraph.add_actor_dict
+        delta = self.locations[:, :, :2] - self.ego_locations[:, None, :2]
+        inner_product = delta[:, :, 0] * self.ego_cos_terms[:, None] + delta[:, :, 1] * self.ego_sin_terms[:, None]
+        length_product = 1 + np.sqrt(delta[:, :, 0]**2 + delta[:, :, 1]**2)
+        with np.errstate(invalid='ignore'):
+            degree = np.degrees(np.arccos(inner_product / length_product))
+            self.visible = self.present & ((degree <= FOV_DEGREE) | ((degree >= 280) & (degree <= 360)))
+
+    #creates the node objects of every frame in SceneGraph's order: road, ego, lanes, then signs and visible actors in framedict order.
+    #node_map[t, actor] is the node index of an actor in frame t (-1 if it is not in the graph).
+    def add_nodes(self, framedicts):
+        num_frames, num_actors = self.present.shape
+        self.node_map = np.full((num_frames, num_actors), -1, dtype=np.int64)
+        self.types = np.full((num_frames, num_actors), -1, dtype=np.int64)
+        self.nodes, self.node_types, self.node_coords = [], [], []
+        self.sign_frames, self.sign_idx = [], []
+        for t, framedict in enumerate(framedicts):
+            ego_attr = framedict['ego']
+            nodes = [Node("Root Road", {}, ActorType.ROAD), Node("ego:"+ego_attr['name'], node_attr(ego_attr), ActorType.CAR),
+                     Node("lane_left", {"curr":"lane_left"}, ActorType.LANE), Node("lane_right", {"curr":"lane_right"}, ActorType.LANE),
+                     Node("lane_middle", {"curr":"lane_middle"}, ActorType.LANE)]
+            for key, attrs in framedict.items():
+                if key == "sign":
+                    for sign_id, signattr in attrs.items():
+                        self.sign_frames.append(t)
+                        self.sign_idx.append(len(nodes))
+                        nodes.append(Node(sign_id, signattr, ActorType.SIGN))
+                elif key == "actors":
+                    for actor_id, attr in attrs.items():
+                        actor = self.actor_ids[actor_id]
+                        if self.visible[t, actor]:
+                            actor_type = actor_type_from_name(attr['name'])
+                            self.node_map[t, actor] = len(nodes)
+                            self.types[t, actor] = actor_type.value
+                            nodes.append(Node(actor_type.name.lower() + ":" + actor_id, node_attr(attr), actor_type))
+            self.nodes.append(nodes)
+            self.node_types.append(np.array([node.type for node in nodes], dtype=np.int64))
+            self.node_coords.append(np.array([node.attr['location'] if 'location' in node.attr else (np.nan, np.nan, np.nan) for node in nodes], dtype=np.float64))
+
+    #left/right and middle isIn relations from the ego-relative lateral displacement (SceneGraph.add_mapping_to_relative_lanes)
+    def add_mapping_to_relative_lanes(self):
+        ego_y = (-self.ego_locations[:, 0]) * self.ego_sin_terms + self.ego_locations[:, 1] * self.ego_cos_terms
+        y_diff = ((-self.locations[:, :, 0]) * self.ego_sin_terms[:, None] + self.locations[:, :, 1] * self.ego_cos_terms[:, None]) - ego_y[:, None]
+        frame, actor = np.nonzero(self.recompute)
+        node_idx, y_diff = self.node_map[frame, actor], y_diff[frame, actor]
+        side = (y_diff < -LANE_THRESHOLD) | (y_diff > LANE_THRESHOLD)
+        middle = np.abs(y_diff) <= CENTER_LANE_THRESHOLD
+        self.add_edges(LANE_SIDE_BLOCK, frame[side], node_idx[side], np.where(y_diff[side] < 0, LEFT_LANE_IDX, RIGHT_LANE_IDX), Relations.isIn.value)
+        self.add_edges(LANE_MIDDLE_BLOCK, frame[middle], node_idx[middle], MIDDLE_LANE_IDX, Relations.isIn.value)
+
+    #cars only build relations with the ego (RelationExtractor.extract_relations_car_car).
+    def add_car_relations(self):
+        distance = np.sqrt(((self.locations - self.ego_locations[:, None, :])**2).sum(axis=2))
+        with np.errstate(invalid='ignore'):
+            near = self.recompute & (self.types == ActorType.CAR.value) & (distance <= CAR_PROXIMITY_THRESH_NEAR)
+        frame, actor = np.nonzero(near)
+        car_idx = self.node_map[frame, actor]
+
+        proximity = PROXIMITY_RELATIONS[np.searchsorted(PROXIMITY_THRESHOLDS, distance[frame, actor], side='left')]
+        self.add_edges(PROXIMITY_BLOCK, frame, EGO_IDX, car_idx, proximity)
+        self.add_edges(PROXIMITY_BACK_BLOCK, frame, car_idx, EGO_IDX, proximity)
+
+        lane_diff = self.lanes[frame, actor] - self.ego_lanes[frame]
+        if np.isnan(lane_diff).any():
+            raise KeyError('lane_idx')
+        car_delta = self.locations[frame, actor, :2] - self.ego_locations[frame, :2]
+        ego = np.full(len(car_idx), EGO_IDX)
+        self.add_directional_relations(DIRECTION_BLOCK, LATERAL_BLOCK, frame, ego, car_idx, self.ego_yaws[frame], car_delta, lane_diff)
+        self.add_directional_relations(DIRECTION_BACK_BLOCK, LATERAL_BACK_BLOCK, frame, car_idx, ego, self.yaws[frame, actor], -car_delta, -lane_diff)
+
+    #peds build a pair of near relations with every ped closer than PED_PROXIMITY_THRESH (RelationExtractor.extract_relations_ped_ped).
+    #the peds of all frames go through one spatial hash; frames are shifted apart along x so no pair spans two frames.
+    def add_ped_relations(self):
+        frame, actor = np.nonzero(self.types == ActorType.PED.value)
+        locations = self.locations[frame, actor]
+        shifted = locations.copy()
+        if len(locations) > 0:
+            shifted[:, 0] += frame * (np.ptp(locations[:, 0]) + 4 * PED_PROXIMITY_THRESH)
+        first, second = candidate_pairs(shifted, PED_PROXIMITY_THRESH + 1) #margin for the rounding of the shift
+        distance = np.sqrt(((locations[first] - locations[second])**2).sum(axis=1))
+        recompute = self.recompute[frame, actor]
+        near = (distance < PED_PROXIMITY_THRESH) & (frame[first] == frame[second]) & (recompute[first] | recompute[second])
+        frame, first, second = frame[first[near]], self.node_map[frame[first[near]], actor[first[near]]], self.node_map[frame[second[near]], actor[second[near]]]
+        first, second = np.minimum(first, second), np.maximum(first, second)
+        self.add_edges(PED_BLOCK, np.repeat(frame, 2), np.stack([first, second], 1).ravel(), np.stack([second, first], 1).ravel(), Relations.near.value)
+
+    #sector relation of dst seen from the heading of src, followed by the lateral relation from the lane indices.
+    def add_directional_relations(self, direction_block, lateral_block, frame, src, dst, yaw, delta, lane_diff):
+        norm = np.sqrt(delta[:, 0]**2 + delta[:, 1]**2)
+        unit_x, unit_y = delta[:, 0] / norm, delta[:, 1] / norm
+        yaw = np.radians(yaw)
+        degree = np.degrees(np.arctan2(np.sin(yaw), np.cos(yaw))) - np.degrees(np.arctan2(unit_y, unit_x))
+        degree[degree < 0] += 360
+        sector = SECTOR_RELATIONS[np.searchsorted(SECTOR_BOUNDS, degree, side='left')]
+        lateral = lane_diff != 0
+        self.add_edges(direction_block, frame, src, dst, sector)
+        self.add_edges(lateral_block, frame[lateral], src[lateral], dst[lateral], np.where(lane_diff[lateral] < 0, Relations.toRightOf.value, Relations.toLeftOf.value))
+
+
+#keeps the previous frame of a clip and only recomputes the relations of actors whose ego-relative position, heading or lane changed
+#by more than the tolerances. relations between unchanged actors (and the ego/lanes) are carried over from the previous frame.
+#with zero tolerances the graphs are the same as the ones of CarlaSceneGraphBuilder.
+#nodes get clip-wide entity ids (graph.entities, names in self.entity_names) so frames can be diffed as (src, dst, relation) triples.
+class IncrementalSceneGraphBuilder(CarlaSceneGraphBuilder):
+    def __init__(self, tolerance=0.1, yaw_tolerance=1.0):
+        self.tolerance = tolerance #feet
+        self.yaw_tolerance = yaw_tolerance #degrees
+        self.reset()
+
+    #starts a new clip
+    def reset(self):
+        self.entity_names = ["Root Road", "ego", "lane_left", "lane_right", "lane_middle"] #the fixed nodes keep their node index as entity id
+        self.entity_ids = {}
+        self.tracked = {} #actor id -> row of self.references
+        self.references = np.zeros((0, 5)) #ego-relative x, y, z, yaw and lane offset of each actor at its last recompute
+        self.was_visible = np.zeros(0, dtype=bool)
+        self.previous = None
+        self.previous_edges = None
+
+    #returns one ArrayGraph per framedict. the framedicts are the frames of one clip in order, numbered in one entity table.
+    def build_clip(self, framedicts):
+        self.reset()
+        return [self.update(framedict)[0] for framedict in framedicts]
+
+    #builds the graph of the next frame of the clip. returns the graph and the (K, 3) arrays of added and removed relation triples.
+    def update(self, framedict):
+        self.gather([framedict])
+        self.add_nodes([framedict])
+        entities = np.array([idx if idx <= MIDDLE_LANE_IDX else self.entity_ids.setdefault(node.name, len(self.entity_ids) + MIDDLE_LANE_IDX + 1)
+                             for idx, node in enumerate(self.nodes[0])], dtype=np.int64)
+        self.entity_names.extend(list(self.entity_ids)[len(self.entity_names) - MIDDLE_LANE_IDX - 1:])
+
+        rows = np.array([self.tracked.setdefault(actor_id, len(self.tracked)) for actor_id in self.actor_ids], dtype=np.int64)
+        num_rows = len(self.tracked)
+        self.references = np.concatenate([self.references, np.full((num_rows - len(self.references), 5), np.nan)])
+        self.was_visible = np.concatenate([self.was_visible, np.zeros(num_rows - len(self.was_visible), dtype=bool)])
+
+        states = self.relative_states()
+        with np.errstate(invalid='ignore'):
+            moved = (np.abs(states[:, :3] - self.references[rows, :3]) > self.tolerance).any(axis=1) \
+                    | (np.abs((states[:, 3] - self.references[rows, 3] + 180) % 360 - 180) > self.yaw_tolerance) \
+                    | ~(states[:, 4] == self.references[rows, 4]) #nan lane offsets are always recomputed
+        changed = moved | ~self.was_visible[rows]
+        self.recompute = self.visible & changed[None, :]
+        self.extract_relations()
+
+        #carry over the relations between stable entities. fixed and sign edges are always added by extract_relations.
+        stable = self.visible[0] & ~changed
+        node_of_entity = np.full(len(self.entity_names), -1, dtype=np.int64)
+        node_of_entity[:MIDDLE_LANE_IDX + 1] = np.arange(MIDDLE_LANE_IDX + 1)
+        node_of_entity[entities[self.node_map[0, stable]]] = self.node_map[0, stable]
+        if self.previous_edges is not None:
+            block, src, dst, rel = self.previous_edges
+            src, dst = node_of_entity[src], node_of_entity[dst]
+            keep = (src >= 0) & (dst >= 0) & (block != FIXED_BLOCK) & (block != SIGN_BLOCK)
+            self.edge_blocks.append((block[keep], np.zeros(keep.sum(), dtype=np.int64), src[keep], dst[keep], rel[keep]))
+
+        block, _, src, dst, rel = [np.concatenate(column) for column in zip(*self.edge_blocks)]
+        self.previous_edges = (block, entities[src], entities[dst], rel)
+        self.references[rows[self.recompute[0]]] = states[self.recompute[0]]
+        self.was_visible[:] = False
+        self.was_visible[rows[self.visible[0]]] = True
+
+        graph = self.assemble()[0]
+        graph.entities = entities
+        added, removed = edge_diff(self.previous, graph)
+        self.previous = graph
+        return graph, added, removed
+
+    #(actors, 5) array of ego-relative x, y, z, yaw and lane offset of the actors of the gathered frame
+    def relative_states(self):
+        delta = self.locations[0] - self.ego_locations[0]
+        cos_term, sin_term = self.ego_cos_terms[0], self.ego_sin_terms[0]
+        return np.stack([delta[:, 0] * cos_term + delta[:, 1] * sin_term, (-delta[:, 0]) * sin_term + delta[:, 1] * cos_term, delta[:, 2],
+                         self.yaws[0] - self.ego_yaws[0], self.lanes[0] - self.ego_lanes[0]], axis=1)
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+#uniform grid over the x/y plane used to find every pair of actors that can be close enough to build a relation.
+#cells are radius wide, so both actors of any pair within the radius are in the same or in neighboring cells.
+#locations is an (N, D) array (D >= 2). distances are checked on all D coordinates, the grid only uses x and y.
+#rows flagged in unlocated (nodes without a location, e.g. lanes) are paired with every other row.
+#returns (first, second) index arrays with first < second, sorted lexicographically like itertools.combinations.
+def candidate_pairs(locations, radius, unlocated=None):
+    locations = np.asarray(locations, dtype=np.float64)
+    num_points = locations.shape[0]
+    if unlocated is None:
+        unlocated = np.zeros(num_points, dtype=bool)
+    located = np.flatnonzero(~unlocated)
+
+    first, second = grid_pairs(locations[located], radius)
+    first, second = located[first], located[second]
+
+    wildcard = np.flatnonzero(unlocated)
+    if len(wildcard) > 0:
+        other = np.tile(np.arange(num_points), len(wildcard))
+        wild = np.repeat(wildcard, num_points)
+        keep = (other != wild) & ~(unlocated[other] & (other < wild)) #pairs between two unlocated rows only once
+        wild, other = wild[keep], other[keep]
+        first = np.concatenate([first, np.minimum(wild, other)])
+        second = np.concatenate([second, np.maximum(wild, other)])
+
+    order = np.lexsort((second, first))
+    return first[order], second[order]
+
+
+#pairs (first < second) of located points whose distance is at most radius.
+def grid_pairs(locations, radius):
+    num_points = locations.shape[0]
+    if num_points < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    cells = np.floor(locations[:, :2] / radius).astype(np.int64)
+    cells -= cells.min(axis=0) - 1 #leave an empty border so neighbor keys never wrap around
+    width = cells[:, 1].max() + 2
+    keys = cells[:, 0] * width + cells[:, 1]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    first, second = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbor_keys = keys + dx * width + dy
+            start = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+            counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - start
+            point = np.repeat(np.arange(num_points), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            other = order[np.repeat(start, counts) + offsets]
+            keep = point < other
+            first.append(point[keep])
+            second.append(other[keep])
+
+    first, second = np.concatenate(first), np.concatenate(second)
+    distance = np.sqrt(((locations[first] - locations[second])**2).sum(axis=1))
+    close = distance <= radius
+    return first[close], second[close]
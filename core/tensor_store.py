@@ -0,0 +1,113 @@
+import json
+import numpy as np
+import torch
+from pathlib import Path
+from core.payload import expand_graph, node_names, ACTOR_ID_PATTERN
+
+
+#columnar on-disk format of a scenegraph dataset (the (scenegraphs_sequence, feature_list) pair written by cache_dataset).
+#the tensors of all graphs are concatenated into one .npy file per column, and offset tables mark where each graph and each
+#sequence starts:
+#   node_features.npy   (total nodes, features)    edge_index.npy  (2, total edges)    edge_attr.npy  (total edges,)
+#   node_offsets.npy    (graphs + 1,)               edge_offsets.npy (graphs + 1,)      sequence_offsets.npy (sequences + 1,)
+#   labels.npy          (sequences,)                meta.json: feature_list, folder names, frame numbers and node names
+#   node_types.npy      (total nodes,) uint8        node_actor_ids.npy (total nodes,)   node_name_ids.npy (total nodes,) into meta names
+#columns keep the compact dtypes of the generators (see core/payload.py) and are upcast when a sequence is read.
+#TensorStore memory-maps the columns, so opening a store reads no tensor data and sequences are slices of the maps.
+STORE_COLUMNS = ('node_features', 'edge_index', 'edge_attr', 'node_offsets', 'edge_offsets', 'sequence_offsets', 'labels',
+                 'node_types', 'node_actor_ids', 'node_name_ids')
+
+
+def write_tensor_store(directory, scenegraphs_sequence, feature_list):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    graphs = [graph for sequence in scenegraphs_sequence for graph in sequence['sequence']]
+    num_features = graphs[0]['node_features'].shape[1] if graphs else len(feature_list)
+    features_dtype = np.result_type(np.uint8, *[graph['node_features'].numpy().dtype for graph in graphs])
+    names = {}
+    nodes = [graph['nodes'] if 'nodes' in graph else legacy_node_table(graph) for graph in graphs]
+
+    columns = {}
+    columns['node_features'] = np.concatenate([np.zeros((0, num_features), dtype=features_dtype)] + [graph['node_features'].numpy() for graph in graphs])
+    columns['edge_index'] = np.concatenate([np.zeros((2, 0), dtype=np.int16)] + [graph['edge_index'].numpy() for graph in graphs], axis=1)
+    columns['edge_attr'] = np.concatenate([np.zeros(0, dtype=np.uint8)] + [graph['edge_attr'].numpy().astype(np.uint8) for graph in graphs])
+    columns['node_types'] = np.concatenate([np.zeros(0, dtype=np.uint8)] + [table['types'].numpy() for table in nodes])
+    columns['node_actor_ids'] = np.concatenate([np.zeros(0, dtype=np.int32)] + [table['actor_ids'].numpy() for table in nodes])
+    columns['node_name_ids'] = np.array([names.setdefault(name, len(names)) for table in nodes for name in table['names']], dtype=np.int32)
+    columns['node_offsets'] = np.cumsum([0] + [graph['node_features'].shape[0] for graph in graphs], dtype=np.int64)
+    columns['edge_offsets'] = np.cumsum([0] + [graph['edge_attr'].shape[0] for graph in graphs], dtype=np.int64)
+    columns['sequence_offsets'] = np.cumsum([0] + [len(sequence['sequence']) for sequence in scenegraphs_sequence], dtype=np.int64)
+    columns['labels'] = np.array([sequence['label'] for sequence in scenegraphs_sequence], dtype=np.int64)
+    for name in STORE_COLUMNS:
+        np.save(str(directory / (name + ".npy")), columns[name])
+
+    meta = {'feature_list': sorted(feature_list) if isinstance(feature_list, set) else list(feature_list), #sets come from caches with sorted columns
+            'folder_names': [sequence['folder_name'] for sequence in scenegraphs_sequence],
+            'frame_numbers': [[graph['frame_number'] for graph in sequence['sequence']] for sequence in scenegraphs_sequence],
+            'node_names': list(names)}
+    with open(str(directory / "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+
+#node table of a graph dict from a cache written before node tables existed. the types are not known there.
+def legacy_node_table(graph):
+    names = node_names(graph)
+    actor_ids = [int(match.group(1)) if match else -1 for match in map(ACTOR_ID_PATTERN.search, names)]
+    return {'names': names, 'types': torch.full((len(names),), 255, dtype=torch.uint8), 'actor_ids': torch.tensor(actor_ids, dtype=torch.int32)}
+
+
+#read side of the columnar format. behaves like the scenegraphs_sequence list: store[i] is a sequence dict whose tensors are
+#read from the memory maps (copy-on-write, so nothing is read until a page is used). compact columns are upcast per sequence,
+#columns already stored with the model dtypes stay views.
+class TensorStore:
+    def __init__(self, directory, indices=None):
+        self.directory = Path(directory)
+        for name in STORE_COLUMNS:
+            setattr(self, name, np.load(str(self.directory / (name + ".npy")), mmap_mode='c'))
+        with open(str(self.directory / "meta.json"), 'r') as f:
+            meta = json.load(f)
+        self.feature_list = meta['feature_list']
+        self.folder_names = meta['folder_names']
+        self.frame_numbers = meta['frame_numbers']
+        self.node_names = meta['node_names']
+        self.indices = np.arange(len(self.labels)) if indices is None else np.asarray(indices, dtype=np.int64)
+
+    #store restricted to the given sequence indices, sharing the memory maps
+    def subset(self, indices):
+        subset = TensorStore.__new__(TensorStore)
+        subset.__dict__.update(self.__dict__)
+        subset.indices = self.indices[np.asarray(indices, dtype=np.int64)]
+        return subset
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        seq_idx = self.indices[idx]
+        sequence = []
+        first = self.sequence_offsets[seq_idx]
+        for frame_idx, graph_idx in enumerate(range(first, self.sequence_offsets[seq_idx + 1])):
+            nodes = slice(self.node_offsets[graph_idx], self.node_offsets[graph_idx + 1])
+            edges = slice(self.edge_offsets[graph_idx], self.edge_offsets[graph_idx + 1])
+            sequence.append(expand_graph({'node_features': torch.from_numpy(self.node_features[nodes]),
+                                          'edge_index': torch.from_numpy(self.edge_index[:, edges]),
+                                          'edge_attr': torch.from_numpy(self.edge_attr[edges]),
+                                          'nodes': {'names': [self.node_names[name_id] for name_id in self.node_name_ids[nodes].tolist()],
+                                                    'types': torch.from_numpy(self.node_types[nodes]),
+                                                    'actor_ids': torch.from_numpy(self.node_actor_ids[nodes])},
+                                          'folder_name': self.folder_names[seq_idx],
+                                          'frame_number': self.frame_numbers[seq_idx][frame_idx]}))
+        return {'sequence': sequence, 'label': int(self.labels[seq_idx]), 'folder_name': self.folder_names[seq_idx]}
+
+    #labels of the sequences of this store
+    @property
+    def sequence_labels(self):
+        return self.labels[self.indices]
+
+
+def is_tensor_store(path):
+    return (Path(path) / "meta.json").exists()
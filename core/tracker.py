@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+
+
+#(N, M) intersection over union of two arrays of x1, y1, x2, y2 boxes
+def box_iou(boxes1, boxes2):
+    boxes1, boxes2 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4), np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    width = np.clip(np.minimum(boxes1[:, None, 2], boxes2[None, :, 2]) - np.maximum(boxes1[:, None, 0], boxes2[None, :, 0]), 0, None)
+    height = np.clip(np.minimum(boxes1[:, None, 3], boxes2[None, :, 3]) - np.maximum(boxes1[:, None, 1], boxes2[None, :, 1]), 0, None)
+    intersection = width * height
+    union = area1[:, None] + area2[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+#greedy matching of two box arrays: repeatedly pairs the two boxes with the highest IoU above threshold.
+#returns (rows, cols) index arrays of the matched boxes.
+def match_boxes(boxes1, boxes2, threshold=0.3):
+    iou = box_iou(boxes1, boxes2)
+    rows, cols = np.nonzero(iou >= threshold)
+    order = np.argsort(-iou[rows, cols], kind='stable')
+    matched1, matched2 = set(), set()
+    pairs = []
+    for row, col in zip(rows[order].tolist(), cols[order].tolist()):
+        if row not in matched1 and col not in matched2:
+            matched1.add(row)
+            matched2.add(col)
+            pairs.append((row, col))
+    pairs.sort()
+    return np.array([row for row, _ in pairs], dtype=np.int64), np.array([col for _, col in pairs], dtype=np.int64)
+
+
+#assigns track ids to the boxes of consecutive detections. a box continues the track of the box of the previous update it
+#overlaps most (IoU above iou_threshold), other boxes start new tracks. tracks that are not matched end.
+class IoUTracker:
+    def __init__(self, iou_threshold=0.3):
+        self.iou_threshold = iou_threshold
+        self.boxes = np.zeros((0, 4))
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.next_id = 0
+
+    #returns the track id of every box
+    def update(self, boxes):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        ids = np.full(len(boxes), -1, dtype=np.int64)
+        previous, current = match_boxes(self.boxes, boxes, self.iou_threshold)
+        ids[current] = self.ids[previous]
+        new = ids < 0
+        ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+        self.boxes, self.ids = boxes, ids
+        return ids
+
+
+#every k-th frame, and the last frame so every other frame lies between two keyframes
+def select_keyframes(frames, k):
+    keyframes = list(frames[::k])
+    if len(frames) > 0 and (len(frames) - 1) % k != 0:
+        keyframes.append(frames[-1])
+    return keyframes
+
+
+#(boxes, classes, scores, image_size, ids) detections of every frame from the detections of the keyframes (see BatchedPredictor.detect).
+#the ids of the keyframe detections are replaced by track ids, so an actor keeps its id over the clip. the boxes of a track are
+#linearly interpolated between the two keyframes around a frame. tracks that end at the next keyframe keep their last box.
+def propagate_detections(frames, keyframes, keyframe_detections, iou_threshold=0.3):
+    tracker = IoUTracker(iou_threshold)
+    tracked = {}
+    for keyframe in keyframes:
+        boxes, classes, scores, image_size, _ = keyframe_detections[keyframe]
+        tracked[keyframe] = (boxes, classes, scores, image_size, torch.from_numpy(tracker.update(boxes.numpy())))
+
+    position = {frame: idx for idx, frame in enumerate(frames)}
+    detections = dict(tracked)
+    for start, end in zip(keyframes, keyframes[1:]):
+        boxes, classes, scores, image_size, ids = tracked[start]
+        end_boxes, end_ids = tracked[end][0], tracked[end][4]
+        _, rows, cols = np.intersect1d(ids.numpy(), end_ids.numpy(), assume_unique=True, return_indices=True)
+        rows, cols = torch.from_numpy(rows), torch.from_numpy(cols)
+        for frame in frames[position[start] + 1:position[end]]:
+            weight = (position[frame] - position[start]) / (position[end] - position[start])
+            frame_boxes = boxes.clone()
+            frame_boxes[rows] = boxes[rows] + (end_boxes[cols] - boxes[rows]) * weight
+            detections[frame] = (frame_boxes, classes, scores, image_size, ids)
+    return detections
@@ -0,0 +1,75 @@
+import csv, os
+import cv2
+from collections import namedtuple
+from pathlib import Path
+
+
+#clip given as an event window of a video instead of a directory of images: frames start, start + stride, ... before end.
+#label is the risk label of the clip, read the same way as the first value of a clip's label.txt.
+class VideoClip(namedtuple('VideoClip', ['name', 'video_path', 'start', 'end', 'stride', 'label'])):
+    __slots__ = ()
+
+    #VideoFrames of the window that exist in the video
+    def frames(self):
+        cap = cv2.VideoCapture(self.video_path)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+        return [VideoFrame(self.video_path, frame_no) for frame_no in range(max(self.start, 0), min(self.end, frame_count), self.stride)]
+
+    #(path, size, modification time) of the video. hashing the contents of a whole session video for every event is too slow,
+    #so cache keys of video clips use the identity of the file instead.
+    def video_identity(self):
+        stat = os.stat(self.video_path)
+        return (str(Path(self.video_path).resolve()), stat.st_size, int(stat.st_mtime))
+
+
+#one frame of a video. stem and name mirror the Path of an image file, so frames are named by their frame number.
+class VideoFrame(namedtuple('VideoFrame', ['video_path', 'frame_no'])):
+    __slots__ = ()
+
+    @property
+    def stem(self):
+        return str(self.frame_no)
+
+    @property
+    def name(self):
+        return "%d.jpg" % self.frame_no
+
+
+#yields (frame, image) for VideoFrames of one video, in increasing frame order. the video is read forward once: frames in
+#between are skipped with grab(), which does not convert them, and a seek is only used to jump over gaps longer than seek_gap frames.
+def read_video_frames(frames, seek_gap=300):
+    frames = sorted(frames, key=lambda frame: frame.frame_no)
+    if len(frames) == 0:
+        return
+    cap = cv2.VideoCapture(frames[0].video_path)
+    position = 0
+    try:
+        for frame in frames:
+            if frame.frame_no < position or frame.frame_no - position > seek_gap:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame.frame_no)
+                position = frame.frame_no
+            while position < frame.frame_no:
+                cap.grab()
+                position += 1
+            ret, image = cap.read()
+            position += 1
+            if not ret:
+                raise IOError("could not decode frame %d of %s" % (frame.frame_no, frame.video_path))
+            yield frame, image
+    finally:
+        cap.release()
+
+
+#reads the VideoClips of an events csv with the columns name, video_path, start, end, stride and label.
+#start and end are frame numbers, relative video paths are relative to the csv file.
+def load_video_clips(events_path):
+    events_path = Path(events_path)
+    clips = []
+    with open(str(events_path), 'r') as f:
+        for row in csv.DictReader(f):
+            video_path = Path(row['video_path'])
+            if not video_path.is_absolute():
+                video_path = events_path.parent / video_path
+            clips.append(VideoClip(row['name'], str(video_path), int(row['start']), int(row['end']), int(row.get('stride') or 1), float(row['label'])))
+    return clips
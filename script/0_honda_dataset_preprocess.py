@@ -1,10 +1,14 @@
 from tqdm import tqdm
 from pathlib import Path
+from collections import defaultdict
 
 
-import argparse, glob, cv2, pprint
+import argparse, glob, cv2, pprint, multiprocessing, os, sys
 import pickle as pkl
 
+sys.path.append(os.path.dirname(sys.path[0]))
+from core.video import VideoFrame, read_video_frames
+
 
 class HondaDataSetHandler:
     def __init__(self):
@@ -43,38 +47,58 @@ class HondaDataSetHandler:
         
         return video_full_path
 
-    def capture_video_clips(self, event_types):
+    # events are grouped by session so every session video is opened once and decoded sequentially (see capture_session_frames).
+    # with workers > 1 the sessions are processed in parallel processes.
+    def capture_video_clips(self, event_types, workers=1):
 
         events = self.cache_data['events_pd'].loc[self.cache_data['events_pd']["event_type"].isin(event_types)]
 
         frame_padding = 30
         frame_rate = self.video_framerate
         sampling_freq = self.sampling_frequency
-        
-        for idx, row in tqdm(events.iterrows()):
+
+        sessions = defaultdict(lambda: defaultdict(list)) # session_id -> frame_no -> output directories of the events using the frame
+        for idx, row in events.iterrows():
             start, end = int(row["start"] / 1000 * frame_rate), int(row["end"] / 1000 * frame_rate)
             session_id = row['session_id']
 
             out_path =  self.dest / (str(idx)+"_"+ session_id)
             out_path.mkdir(exist_ok=True)
 
-            video_path = self.get_video_path(session_id)
-
-            cap = cv2.VideoCapture(video_path)
-            max_frame_no = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            
             for frame_no in range(start - frame_padding, end + frame_padding, sampling_freq):
-                if frame_no > 0  and frame_no < max_frame_no:
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-                    ret, frame = cap.read()
-                    outname = out_path /  (str(frame_no)+'.jpg')
-                    # frame = cv2.resize(frame,(1024,1024))
-                    cv2.imwrite(str(outname), frame)
-            cap.release()
+                sessions[session_id][frame_no].append(out_path)
+
+        jobs = [(self.get_video_path(session_id), dict(frames)) for session_id, frames in sessions.items()]
+        if workers <= 1:
+            for job in tqdm(jobs):
+                capture_session_frames(job)
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                for _ in tqdm(pool.imap_unordered(capture_session_frames, jobs), total=len(jobs)):
+                    pass
+
+
+# writes the frames of one session video to the output directories of the events using them.
+# frames maps a frame number to a list of output directories. the video is read forward once by read_video_frames (core/video.py).
+def capture_session_frames(job):
+    video_path, frames = job
+    cap = cv2.VideoCapture(video_path)
+    max_frame_no = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    video_frames = [VideoFrame(video_path, frame_no) for frame_no in frames if frame_no > 0 and frame_no < max_frame_no]
+    for video_frame, frame in read_video_frames(video_frames):
+        for out_path in frames[video_frame.frame_no]:
+            outname = out_path /  (str(video_frame.frame_no)+'.jpg')
+            # frame = cv2.resize(frame,(1024,1024))
+            cv2.imwrite(str(outname), frame)
+    return video_path
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cuts the Honda event clips out of the session videos.")
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes decoding session videos in parallel.')
+    args = parser.parse_args()
     data_handler = HondaDataSetHandler()
     event_types = [3, 5]
-    data_handler.capture_video_clips(event_types)
+    data_handler.capture_video_clips(event_types, workers=args.workers)
     
@@ -8,13 +8,30 @@ sys.path.append(os.path.dirname(sys.path[0]))
 class Config:
     def __init__(self, args):
         self.parser = ArgumentParser(description="Parameters for extracting scenegraphs.")
-        self.parser.add_argument('--input_path', type=str, default="/home/louisccc/NAS/louisccc/av/synthesis_data/new_recording_3", help="Path to lane-change clips directory.")
+        self.parser.add_argument('--input_path', type=str, default="/home/louisccc/NAS/louisccc/av/synthesis_data/new_recording_3", help="Path to lane-change clips directory. For image and honda also an events csv (name, video_path, start, end, stride, label) to read the frames straight from videos.")
         self.parser.add_argument('--platform', type=str, default="carla", help="Method for scenegraph extraction (carla or image or honda).")
         self.parser.add_argument('--cache', type=lambda x: (str(x).lower() == 'true'), default=True, help="Cache processed scenegraphs.")
         self.parser.add_argument('--address', type=str, default="./image_dataset.pkl", help="Path to save cache file.")
+        self.parser.add_argument('--cache_format', type=str, default="pickle", help="Format of the cache: pickle (one file) or columnar (memory-mappable directory).")
         self.parser.add_argument('--visualize', type=lambda x: (str(x).lower() == 'true'), default=False, help="Visualize scenegraphs.")
         self.parser.add_argument('--vis_clipids', type=int, nargs='+', default=None, help='Folder Ids of the lane change clip to visualize.')
         self.parser.add_argument('--framenum', type=int, default=10, help='Number of frames to extract from each video clip.')
+        self.parser.add_argument('--relative_features', type=lambda x: (str(x).lower() == 'true'), default=False, help="Add ego-relative location and distance node features.")
+        self.parser.add_argument('--clip_cache', type=str, default=None, help='Directory of the per-clip extraction cache. Only new or changed clips are extracted.')
+        self.parser.add_argument('--detection_cache', type=str, default=None, help='Directory of the per-clip object detection cache (image and honda). Re-extraction with new graph rules skips detection.')
+        self.parser.add_argument('--workers', type=int, default=1, help='Number of processes extracting clips in parallel.')
+        self.parser.add_argument('--fail_fast', type=lambda x: (str(x).lower() == 'true'), default=False, help="Stop at the first clip that fails instead of skipping it and listing the failed clips at the end.")
+        self.parser.add_argument('--frame_selection', type=str, default="modulo", help='Policy choosing which frames of a clip are kept (modulo, uniform or last).')
+        self.parser.add_argument('--detect_batch_size', type=int, default=8, help='Number of frames per object detection forward call (image and honda).')
+        self.parser.add_argument('--torch_threads', type=int, default=None, help='Number of torch intra-op threads used by object detection (image and honda).')
+        self.parser.add_argument('--detector_mode', type=str, default="mask", help='Object detector mode (image and honda): mask (full Mask R-CNN) or box (no mask head, vehicle detections only).')
+        self.parser.add_argument('--detect_roi', type=int, nargs=4, default=None, help='Crop images to this x1 y1 x2 y2 pixel region before object detection (image and honda).')
+        self.parser.add_argument('--detect_min_size', type=int, default=None, help='Reduced input resolution (shortest side in pixels) of the object detector (image and honda).')
+        self.parser.add_argument('--detect_every', type=int, default=None, help='Run object detection on every k-th frame of a clip only and track the actors in between, with stable node ids (image and honda).')
+        self.parser.add_argument('--use_lanes', type=lambda x: (str(x).lower() == 'true'), default=False, help="Map actors to lanes with the lane masks of raw_images/lanedicts.pkl where present instead of the distance thresholds (image and honda).")
+        self.parser.add_argument('--decode_threads', type=int, default=4, help='Number of threads decoding images ahead of object detection (image and honda).')
+        self.parser.add_argument('--delta_tolerance', type=float, default=None, help='Build CARLA scenegraphs incrementally, only recomputing actors that moved more than this many feet (or turned more than --delta_yaw_tolerance) relative to the ego. Also stores per-frame edge diffs.')
+        self.parser.add_argument('--delta_yaw_tolerance', type=float, default=None, help='Degrees of heading change relative to the ego after which --delta_tolerance recomputes an actor. Defaults to 0 (exact graphs) with --delta_tolerance 0, else 1.')
 
         args_parsed = self.parser.parse_args(args)
             
@@ -30,19 +47,29 @@ if __name__ == '__main__':
 
     if cfg.platform == "carla":
         from core.carla_seq_generator import CarlaSceneGraphSequenceGenerator
-        generator = CarlaSceneGraphSequenceGenerator(cfg.framenum)
-    elif cfg.platform == "image":
+        generator = CarlaSceneGraphSequenceGenerator(cfg.framenum, delta_tolerance=cfg.delta_tolerance, delta_yaw_tolerance=cfg.delta_yaw_tolerance, frame_selection=cfg.frame_selection, relative_features=cfg.relative_features)
+    elif cfg.platform in ("image", "honda"):
         from core.real_seq_generator import ImageSceneGraphSequenceGenerator
-        generator = ImageSceneGraphSequenceGenerator(cfg.framenum)
-    elif cfg.platform == "honda":
-        from core.real_seq_generator import ImageSceneGraphSequenceGenerator
-        generator = ImageSceneGraphSequenceGenerator(cfg.framenum, platform='honda')
+        generator = ImageSceneGraphSequenceGenerator(cfg.framenum, platform=cfg.platform, relative_features=cfg.relative_features, frame_selection=cfg.frame_selection,
+                                                     detect_batch_size=cfg.detect_batch_size, torch_threads=cfg.torch_threads, decode_threads=cfg.decode_threads,
+                                                     detector_mode=cfg.detector_mode, detect_roi=cfg.detect_roi, detect_min_size=cfg.detect_min_size, detect_every=cfg.detect_every,
+                                                     use_lanes=cfg.use_lanes)
+        if cfg.torch_threads:
+            import torch
+            torch.set_num_threads(cfg.torch_threads)
 
     if cfg.visualize:
         generator.visualize_scenegraphs(cfg.vis_clipids)
 
-    generator.load(cfg.input_base_dir)
+    if cfg.platform == "carla":
+        generator.load(cfg.input_base_dir, workers=cfg.workers, clip_cache=cfg.clip_cache, fail_fast=cfg.fail_fast)
+    else:
+        generator.load(cfg.input_base_dir, workers=cfg.workers, clip_cache=cfg.clip_cache, detection_cache=cfg.detection_cache, fail_fast=cfg.fail_fast)
     if cfg.cache:
-        generator.cache_dataset(str(cfg.cache_path))
+        if cfg.cache_format == "columnar":
+            from core.tensor_store import write_tensor_store
+            write_tensor_store(cfg.cache_path, generator.scenegraphs_sequence, generator.feature_list)
+        else:
+            generator.cache_dataset(str(cfg.cache_path))
 
    
\ No newline at end of file
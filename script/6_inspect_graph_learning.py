@@ -12,6 +12,7 @@ matplotlib.use("Agg")
 sys.path.append(os.path.dirname(sys.path[0]))
 from core.dynkg_trainer import *
 from core.relation_extractor import Relations
+from core.payload import node_names
 
 
 def add_node(g, node, label):
@@ -54,38 +55,36 @@ def parse_attn_weights(node_attns, sequences, dest_dir, visualize=False):
     filtered_nodes = defaultdict(list)
     for idx, (p, b, s) in enumerate(zip(pool_perm, pool_batch, pool_score)):
         node_index[idx] = p - batch_deduct[b]
-        inv_node_order = {v: k for k, v in sequences[b]['node_order'].items()}
+        names = node_names(sequences[b])
         if b not in node_dict:
             node_dict[b] = []
-        node_dict[b].append("%s:%f"%(inv_node_order[node_index[idx]], s))
-        filtered_nodes[b].append([inv_node_order[node_index[idx]], s])
+        node_dict[b].append("%s:%f"%(names[node_index[idx]], s))
+        filtered_nodes[b].append([node_index[idx], s])
     node_attns_list.append(node_dict)
 
     if visualize:
         for idx in range(len(sequences)):
             scenegraph_edge_idx = sequences[idx]['edge_index'].numpy()
             scenegraph_edge_attr = sequences[idx]['edge_attr'].numpy()
-            scenegraph_node_order = sequences[idx]['node_order']
-            reversed_node_order = {v: k for k, v in scenegraph_node_order.items()}
+            names = node_names(sequences[idx])
             reversed_g = nx.MultiGraph()
             
             for edge_idx in range(scenegraph_edge_idx.shape[1]):
                 src_idx = scenegraph_edge_idx[0][edge_idx]
                 dst_idx = scenegraph_edge_idx[1][edge_idx]
-                src_node_name = reversed_node_order[src_idx].name
-                dst_node_name = reversed_node_order[dst_idx].name
+                src_node_name = names[src_idx]
+                dst_node_name = names[dst_idx]
                 relation = scenegraph_edge_attr[edge_idx]
 
                 add_node(reversed_g, src_idx, src_node_name)
                 add_node(reversed_g, dst_idx, dst_node_name)
                 add_relation(reversed_g, src_idx, relation, dst_idx)
             
-            for node, score in filtered_nodes[idx]:
-                node_idx = scenegraph_node_order[node]
+            for node_idx, score in filtered_nodes[idx]:
                 rgb_color = colormap(float(score))[:3]
                 hsv_color =[str(x) for x in matplotlib.colors.rgb_to_hsv(rgb_color)]
                 if node_idx not in reversed_g.nodes:
-                    add_node(reversed_g, node_idx, node.name)
+                    add_node(reversed_g, node_idx, names[node_idx])
                 reversed_g.nodes[node_idx]['fillcolor'] = ','.join(hsv_color)
                 reversed_g.nodes[node_idx]['label'] += '\n' + str(round(float(score), 5))
 